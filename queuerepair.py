@@ -1,12 +1,239 @@
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
+import gc
 import json
 import os
+import threading
+import time
 from datetime import datetime
 from pathlib import Path
-import csv
 from collections import Counter
 
+from queuerepair_core import RepairQueue
+from queuerepair_diagnostics import LoopMonitor, diagnostics
+from queuerepair_export import FILE_TYPES, export_devices
+from queuerepair_search import SearchScheduler
+from queuerepair_store import ConflictError
+
+class VirtualTreeview:
+    # Keeps the full result list as plain ticket ids and only materializes
+    # the rows that fit in the viewport, so scrolling or refreshing costs a
+    # screenful of Tk calls no matter how many tickets match.
+    def __init__(self, tree, scrollbar, row_values, buffer=1):
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.row_values = row_values
+        self.buffer = buffer
+        self.ids = []
+        self.offset = 0
+        self.selected = set()
+        self.page = int(tree.cget("height"))
+
+        scrollbar.configure(command=self.yview)
+        tree.bind("<Configure>", self._on_resize)
+        tree.bind("<<TreeviewSelect>>", self._on_select)
+        tree.bind("<ButtonPress-1>", self._on_click)
+        tree.bind("<MouseWheel>", self._on_mousewheel)
+        tree.bind("<Button-4>", lambda e: self.scroll(-3) or "break")
+        tree.bind("<Button-5>", lambda e: self.scroll(3) or "break")
+        tree.bind("<Up>", lambda e: self._move_focus(-1))
+        tree.bind("<Down>", lambda e: self._move_focus(1))
+        tree.bind("<Prior>", lambda e: self._move_focus(-self.page))
+        tree.bind("<Next>", lambda e: self._move_focus(self.page))
+        tree.bind("<Home>", lambda e: self._move_focus(-len(self.ids)))
+        tree.bind("<End>", lambda e: self._move_focus(len(self.ids)))
+
+    def set_ids(self, ids, keep_position=False):
+        self.ids = list(ids)
+        if not keep_position:
+            self.offset = 0
+        self.selected.intersection_update(self.ids)
+        self.render()
+
+    def extend(self, ids):
+        start = len(self.ids)
+        self.ids.extend(ids)
+        if start < self.offset + self.page + self.buffer:
+            self.render()
+        else:
+            self._update_scrollbar()
+
+    def selection(self):
+        return sorted(self.selected)
+
+    def select(self, device_id):
+        self.selected = {device_id}
+        self.tree.selection_set(str(device_id))
+
+    def show(self, device_id):
+        # Scrolls to a ticket and selects it; False if it isn't in the list
+        try:
+            index = self.ids.index(device_id)
+        except ValueError:
+            return False
+        if not self.offset <= index < self.offset + self.page:
+            self._set_offset(index - self.page // 2)
+        self.select(device_id)
+        self.tree.focus(str(device_id))
+        return True
+
+    def refresh(self, device_id):
+        iid = str(device_id)
+        if self.tree.exists(iid):
+            values = self.row_values(device_id)
+            if values is None:
+                self.remove(device_id)
+            else:
+                self.tree.item(iid, values=values)
+
+    def insert(self, device_id, index=None):
+        if index is None:
+            index = len(self.ids)
+        self.ids.insert(index, device_id)
+        if index < self.offset + self.page + self.buffer:
+            self.render()
+        else:
+            self._update_scrollbar()
+
+    def remove(self, *device_ids):
+        if len(device_ids) == 1:
+            try:
+                index = self.ids.index(device_ids[0])
+            except ValueError:
+                return
+            del self.ids[index]
+            if index < self.offset:
+                self.offset -= 1
+        else:
+            gone = set(device_ids)
+            self.offset -= sum(1 for i in self.ids[:self.offset] if i in gone)
+            self.ids = [i for i in self.ids if i not in gone]
+        self.selected.difference_update(device_ids)
+        self.render()
+
+    def scroll(self, rows):
+        self._set_offset(self.offset + rows)
+
+    def yview(self, *args):
+        if args[0] == "moveto":
+            self._set_offset(int(float(args[1]) * len(self.ids)))
+        elif args[0] == "scroll":
+            step = self.page if args[2] == "pages" else 1
+            self.scroll(int(args[1]) * step)
+
+    def render(self):
+        with diagnostics.measure("render", rows=len(self.ids)):
+            self._clamp()
+            window = self.ids[self.offset:self.offset + self.page + self.buffer]
+            rows = [(device_id, self.row_values(device_id)) for device_id in window]
+            gone = {device_id for device_id, values in rows if values is None}
+            if gone:
+                # Tickets deleted by another instance since the list was built
+                self.ids = [i for i in self.ids if i not in gone]
+                self.selected.difference_update(gone)
+                self.render()
+                return
+            self.tree.delete(*self.tree.get_children())
+            for device_id, values in rows:
+                self.tree.insert("", "end", iid=str(device_id), values=values)
+            self.tree.selection_set([str(i) for i in window if i in self.selected])
+            self.tree.yview_moveto(0)
+            self._update_scrollbar()
+
+    def _set_offset(self, offset):
+        old = self.offset
+        self.offset = offset
+        self._clamp()
+        if self.offset != old:
+            self.render()
+
+    def _clamp(self):
+        self.offset = max(0, min(self.offset, len(self.ids) - self.page))
+
+    def _update_scrollbar(self):
+        total = len(self.ids)
+        if total <= self.page:
+            self.scrollbar.set(0, 1)
+        else:
+            self.scrollbar.set(self.offset / total, min(1, (self.offset + self.page) / total))
+
+    def _on_resize(self, event):
+        rowheight = ttk.Style().lookup("Treeview", "rowheight") or 20
+        rowheight = int(rowheight)
+        page = max(1, (event.height - rowheight - 4) // rowheight)
+        if page != self.page:
+            self.page = page
+            self.render()
+
+    def _on_select(self, event=None):
+        window = self.ids[self.offset:self.offset + self.page + self.buffer]
+        self.selected.difference_update(window)
+        self.selected.update(int(iid) for iid in self.tree.selection())
+
+    def _on_click(self, event):
+        # A plain click starts a new selection, including rows scrolled away
+        if not event.state & 0x0005:
+            self.selected.clear()
+
+    def _on_mousewheel(self, event):
+        notches = event.delta // 120 if abs(event.delta) >= 120 else (1 if event.delta > 0 else -1)
+        self.scroll(-notches * 3)
+        return "break"
+
+    def _move_focus(self, delta):
+        focus = self.tree.focus()
+        if not self.ids:
+            return "break"
+        if focus and self.tree.exists(focus):
+            index = self.offset + self.tree.index(focus)
+        else:
+            index = self.offset - (1 if delta > 0 else 0)
+        index = max(0, min(index + delta, len(self.ids) - 1))
+
+        if index < self.offset:
+            self.offset = index
+        elif index >= self.offset + self.page:
+            self.offset = index - self.page + 1
+        device_id = self.ids[index]
+        self.selected = {device_id}
+        self.render()
+        self.tree.focus(str(device_id))
+        return "break"
+
+class BackgroundTask:
+    # Runs work(progress) on a worker thread and reports back on the Tk loop:
+    # on_progress(value) while it runs, on_done(result, error) at the end.
+    def __init__(self, root, work, on_progress, on_done, poll_ms=100):
+        self.root = root
+        self.work = work
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.poll_ms = poll_ms
+        self.progress = 0
+        self.result = None
+        self.error = None
+        self.done = False
+        threading.Thread(target=self._run, daemon=True).start()
+        self.root.after(self.poll_ms, self._poll)
+
+    def _run(self):
+        try:
+            self.result = self.work(self._set_progress)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+
+    def _set_progress(self, value):
+        self.progress = value
+
+    def _poll(self):
+        if self.done:
+            self.on_done(self.result, self.error)
+        else:
+            self.on_progress(self.progress)
+            self.root.after(self.poll_ms, self._poll)
+
 class QueueRepairApp:
     def __init__(self, root):
         self.root = root
@@ -16,33 +243,161 @@ class QueueRepairApp:
         
         # Data setup
         self.data_dir = Path("QueueRepairData")
-        self.data_file = self.data_dir / "repair_data.json"
-        self.data_dir.mkdir(exist_ok=True)
+        self.queue = RepairQueue(self.data_dir)
+        self.store = self.queue.store
+        self.sort = []
+        self.export_task = None
+        self.poll_ms = 2000
+        self.search_archive = False
+        self.diagnostics_window = None
+        self.duplicate_check = None
         
-        self.devices = self.load_data()
         self.create_widgets()
         self.setup_keyboard_shortcuts()
         self.create_context_menu()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.loop_monitor = LoopMonitor(self.root, diagnostics)
+        self.load_data()
 
     def load_data(self):
+        # Tickets are read in batches between Tk events, so the window shows
+        # up straight away and the list fills in while the file is parsed.
+        self.loading = True
+        self.load_started = time.perf_counter()
+        # Loading only allocates tickets that stay for the life of the app, so
+        # the collector's full scans every few thousand of them are wasted
+        # work that stalls a slice; it is switched back on in finish_loading
+        gc.disable()
+        self.status_var.set("Loading tickets...")
         try:
-            if self.data_file.exists():
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            return []
+            # Small batches, so the time check between them keeps each slice
+            # of loading short enough not to be felt
+            self.loader = self.store.load_iter(batch_size=200)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load data: {str(e)}")
+            self.finish_loading()
+            return
+        self.root.after(1, self.load_next_batch)
+
+    def load_next_batch(self):
+        deadline = time.perf_counter() + 0.05
+        try:
+            while time.perf_counter() < deadline:
+                batch = next(self.loader, None)
+                if batch is None:
+                    self.finish_loading()
+                    return
+                if not self.search_entry.get() and not self.sort and not self.search.busy:
+                    self.view.extend([d['id'] for d in batch])
         except json.JSONDecodeError:
-            messagebox.showwarning("Warning", "Data file is corrupted. Starting with empty data.")
-            return []
+            messagebox.showwarning("Warning", "Data file is corrupted. Only the tickets before the damaged part were loaded.")
+            self.finish_loading()
+            return
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load data: {str(e)}")
-            return []
+            self.finish_loading()
+            return
+        
+        self.status_var.set(f"Loading tickets... {self.store.load_progress:.0%} ({len(self.store)} loaded)")
+        self.update_counter()
+        self.root.after(1, self.load_next_batch)
+
+    def finish_loading(self):
+        self.loading = False
+        self.loader = None
+        # The loaded tickets are moved out of the collector's reach once, so
+        # later collections only scan what the app creates from here on
+        gc.enable()
+        gc.freeze()
+        diagnostics.record("load", time.perf_counter() - self.load_started, tickets=len(self.store))
+        self.status_var.set("Ready • Ctrl+N: New • Ctrl+F: Search • Ctrl+D: Dashboard")
+        self.load_treeview()
+        self.root.after(self.poll_ms, self.poll_changes)
+        if 'archive_after_days' in self.queue.settings:
+            self.archive_old_tickets()
+
+    def archive_old_tickets(self):
+        # Closed tickets past archive_after_days (settings.json) are written
+        # to the archive in the background, then dropped from the list
+        moved = self.queue.archivable()
+        if not moved:
+            return
+        BackgroundTask(
+            self.root,
+            lambda progress: self.queue.archive.add(moved),
+            lambda progress: None,
+            lambda result, error: self.finish_archive(moved, error))
+
+    def finish_archive(self, moved, error):
+        if error is not None:
+            messagebox.showerror("Archive Error", f"Failed to archive old tickets: {str(error)}")
+            return
+        self.queue.finish_archive(moved)
+        self.filter_devices(keep_position=True)
+        self.status_var.set(f"{len(moved)} old closed tickets moved to the archive")
 
-    def save_data(self):
+    def poll_changes(self):
+        # Other technicians may be working on the same QueueRepairData folder;
+        # their saves are merged in every couple of seconds.
         try:
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(self.devices, f, indent=2)
+            changed = self.queue.poll()
+            if changed is None:
+                self.load_treeview()
+                self.status_var.set("Tickets reloaded with changes from other users")
+            elif changed:
+                self.show_remote_changes(changed)
+                self.status_var.set(f"{len(changed)} ticket(s) updated by another user")
+        except Exception as e:
+            # Tried again on the next round (a file may be half written)
+            self.status_var.set(f"Could not check for changes from other users: {e}")
+        finally:
+            self.root.after(self.poll_ms, self.poll_changes)
+
+    def show_remote_changes(self, device_ids):
+        if self.search.busy or self.sort or len(device_ids) > 50:
+            # The new versions may belong somewhere else in the order
+            self.filter_devices(keep_position=True)
+            return
+        query = self.search_entry.get()
+        shown = set(self.view.ids)
+        gone = [i for i in device_ids if i in shown and self.store.get(i) is None]
+        if gone:
+            self.view.remove(*gone)
+        for device_id in sorted(device_ids):
+            if device_id in gone:
+                continue
+            if device_id in shown:
+                self.refresh_device(device_id)
+            elif self.store.get(device_id) is not None and self.store.matches(device_id, query):
+                self.view.insert(device_id)
+        self.update_counter()
+
+    def check_loaded(self):
+        if self.loading:
+            messagebox.showinfo("Please Wait", "Tickets are still loading, try again in a moment")
+            return False
+        return True
+
+    def save_data(self, changed=(), deleted=()):
+        # Only the changed records hit the disk; the full snapshot is
+        # rewritten in the background once enough changes pile up.
+        try:
+            self.queue.save(changed, deleted)
+        except ConflictError as e:
+            messagebox.showwarning("Changed by Another User", str(e))
+            self.show_remote_changes(e.ids)
         except Exception as e:
             messagebox.showerror("Error", f"Failed to save data: {str(e)}")
+        
+        if self.store.compact_error:
+            error, self.store.compact_error = self.store.compact_error, None
+            messagebox.showerror("Error", f"Failed to write data snapshot: {str(error)}")
+
+    def on_close(self):
+        try:
+            self.queue.close()
+        finally:
+            self.root.destroy()
 
     def setup_keyboard_shortcuts(self):
         self.root.bind('<Control-n>', lambda e: self.add_device())
@@ -50,6 +405,7 @@ class QueueRepairApp:
         self.root.bind('<Delete>', lambda e: self.delete_device())
         self.root.bind('<Control-e>', lambda e: self.export_to_csv())
         self.root.bind('<Control-d>', lambda e: self.show_dashboard())
+        self.root.bind('<Control-D>', lambda e: self.show_diagnostics())
         self.root.bind('<Escape>', lambda e: self.search_entry.delete(0, tk.END) or self.filter_devices())
 
     def create_context_menu(self):
@@ -58,6 +414,7 @@ class QueueRepairApp:
         self.context_menu.add_command(label="Cancel Repair", command=self.cancel_repair)
         self.context_menu.add_separator()
         self.context_menu.add_command(label="Copy Details", command=self.copy_details)
+        self.context_menu.add_command(label="Restore from Archive", command=self.restore_archived)
         self.context_menu.add_separator()
         self.context_menu.add_command(label="Delete", command=self.delete_device)
         
@@ -66,14 +423,15 @@ class QueueRepairApp:
     def show_context_menu(self, event):
         item = self.tree.identify_row(event.y)
         if item:
-            self.tree.selection_set(item)
+            self.view.select(int(item))
             self.context_menu.post(event.x_root, event.y_root)
 
     def copy_details(self):
-        selected = self.tree.selection()
+        selected = self.view.selection()
         if selected:
-            item = self.tree.item(selected[0])
-            values = item['values']
+            values = self.row_values(selected[0])
+            if values is None:
+                return
             details = f"ID: {values[0]}\nDevice: {values[1]}\nSerial: {values[2]}\nIssue: {values[3]}\nStatus: {values[6]}"
             self.root.clipboard_clear()
             self.root.clipboard_append(details)
@@ -94,6 +452,7 @@ class QueueRepairApp:
         # Dashboard button
         self.dashboard_btn = ttk.Button(title_frame, text="Dashboard", command=self.show_dashboard)
         self.dashboard_btn.pack(side=tk.RIGHT, padx=10)
+        ttk.Button(title_frame, text="Duplicates", command=self.show_duplicates).pack(side=tk.RIGHT)
         
         # Search frame
         search_frame = tk.Frame(main_frame, bg="#d4d0c8")
@@ -102,16 +461,22 @@ class QueueRepairApp:
         tk.Label(search_frame, text="Search:", bg="#d4d0c8", font=("Arial", 10)).pack(side=tk.LEFT)
         self.search_entry = tk.Entry(search_frame, width=40, relief="sunken", font=("Arial", 10))
         self.search_entry.pack(side=tk.LEFT, padx=5)
-        self.search_entry.bind("<KeyRelease>", self.filter_devices)
+        self.search_entry.bind("<KeyRelease>", self.on_search_key)
+        
+        self.include_archive = tk.BooleanVar()
+        tk.Checkbutton(search_frame, text="Include archive", variable=self.include_archive,
+                      command=self.toggle_archive, bg="#d4d0c8").pack(side=tk.LEFT, padx=5)
         
         dash_export_frame = tk.Frame(main_frame, bg="#d4d0c8")
         dash_export_frame.pack(fill=tk.X, padx=5, pady=5)
 
         tk.Label(dash_export_frame, bg="#d4d0c8")
 
-        # Export button
+        # Export / import buttons
         self.export_btn = ttk.Button(title_frame, text="Export CSV", command=self.export_to_csv)
         self.export_btn.pack(side=tk.RIGHT, padx=10)
+        ttk.Button(title_frame, text="Export As...", command=self.export_as).pack(side=tk.RIGHT)
+        ttk.Button(title_frame, text="Import...", command=self.import_tickets).pack(side=tk.RIGHT, padx=10)
         
         # Form frame
         form_frame = tk.Frame(main_frame, bg="#d4d0c8")
@@ -138,6 +503,12 @@ class QueueRepairApp:
         self.contact_entry = tk.Entry(form_frame, width=30, relief="sunken", font=("Arial", 10))
         self.contact_entry.grid(row=2, column=1, padx=5, pady=5, columnspan=3, sticky="ew")
         
+        # Open tickets that look like the device being typed in
+        self.duplicate_hint = tk.Label(form_frame, text="", fg="#a00000", bg="#d4d0c8", font=("Arial", 9), anchor="w")
+        self.duplicate_hint.grid(row=3, column=1, columnspan=3, padx=5, sticky="w")
+        for entry in (self.device_entry, self.serial_entry, self.submitted_entry, self.contact_entry):
+            entry.bind("<KeyRelease>", self.on_form_key)
+        
         # Buttons
         button_frame = tk.Frame(main_frame, bg="#d4d0c8")
         button_frame.pack(pady=10)
@@ -183,20 +554,23 @@ class QueueRepairApp:
             ("date_repaired", "Date Repaired", 100, "w")
         ]
         
+        self.headings = {}
         for col, heading, width, anchor in col_configs:
+            self.headings[col] = heading
             self.tree.heading(col, text=heading)
             self.tree.column(col, width=width, anchor=anchor)
         
-        # Add sorting
+        # Add sorting (Shift+click adds a secondary sort column)
         for col in columns:
             self.tree.heading(col, command=lambda c=col: self.sort_treeview(c))
+        self.tree.bind("<Shift-Button-1>", self.on_shift_click)
         
-        scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=self.tree.yview)
-        self.tree.configure(yscrollcommand=scrollbar.set)
+        scrollbar = ttk.Scrollbar(tree_frame, orient="vertical")
         scrollbar.pack(side="right", fill="y")
         self.tree.pack(fill=tk.BOTH, expand=True)
-        
-        self.load_treeview()
+        self.view = VirtualTreeview(self.tree, scrollbar, self.row_values)
+        self.search = SearchScheduler(self.root, self.run_search, self.show_search_results,
+                                      on_error=lambda e: messagebox.showerror("Search Error", str(e)))
         
         # Status bar
         self.status_var = tk.StringVar()
@@ -204,77 +578,212 @@ class QueueRepairApp:
         tk.Label(self.root, textvariable=self.status_var, bd=1, 
                 relief="sunken", anchor="w", bg="#d4d0c8").pack(side=tk.BOTTOM, fill=tk.X)
 
-    def filter_devices(self, event=None):
-        search_term = self.search_entry.get().lower()
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-        
-        filtered_count = 0
-        for device in self.devices:
-            if (search_term in device['device'].lower() or 
-                search_term in device['serial'].lower() or 
-                search_term in device['issue'].lower() or
-                search_term in device['submitted'].lower()):
-                
-                values = (
-                    device['id'],
-                    device['device'],
-                    device['serial'],
-                    device['issue'],
-                    device['submitted'],
-                    device['contact'],
-                    device['status'],
-                    device['date_repaired']
-                )
-                self.tree.insert("", "end", values=values)
-                filtered_count += 1
-        
-        self.counter_label.config(text=f"Showing {filtered_count} of {len(self.devices)} devices")
-
-    def sort_treeview(self, col):
-        items = [(self.tree.set(item, col), item) for item in self.tree.get_children('')]
-        items.sort()
-        
-        for index, (val, item) in enumerate(items):
-            self.tree.move(item, '', index)
+    def row_values(self, device_id):
+        # None once the ticket is gone from both the queue and the archive
+        device = self.store.get(device_id)
+        if device is None:
+            archived = self.queue.archive.get(device_id)
+            if archived is None:
+                return None
+            device = dict(archived)
+            device['status'] += " (archived)"
+        return (
+            device['id'],
+            device['device'],
+            device['serial'],
+            device['issue'],
+            device['submitted'],
+            device['contact'],
+            device['status'],
+            device['date_repaired']
+        )
+
+    def on_search_key(self, event=None):
+        self.search.schedule(self.search_entry.get())
+
+    def filter_devices(self, event=None, keep_position=False):
+        self.search.submit(self.search_entry.get(), keep_position=keep_position)
+
+    def run_search(self, query, cancelled):
+        # Runs on the search worker thread
+        return self.queue.search(query, self.sort, include_archive=self.search_archive, cancelled=cancelled)
+
+    def toggle_archive(self):
+        self.search_archive = self.include_archive.get()
+        self.filter_devices()
+
+    def active_selection(self):
+        # Selected tickets that are in the working set, not the archive
+        selected = [i for i in self.view.selection() if i in self.store]
+        if self.view.selection() and not selected:
+            messagebox.showinfo("Archived", "Archived tickets can't be changed. "
+                                "Right-click and choose Restore from Archive first.")
+        return selected
+
+    def restore_archived(self):
+        selected = [i for i in self.view.selection() if i not in self.store]
+        if not selected:
+            messagebox.showinfo("Info", "This ticket is not archived")
+            return
+        try:
+            restored = self.queue.restore(selected)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to restore: {str(e)}")
+            return
+        for device in restored:
+            self.view.refresh(device['id'])
+        self.update_counter()
+        self.status_var.set(f"{len(restored)} ticket(s) restored from the archive")
+
+    def show_search_results(self, ids, first, done, keep_position):
+        if first:
+            self.view.set_ids(ids, keep_position=keep_position)
+        elif ids:
+            self.view.extend(ids)
+        self.update_counter()
+
+    def refresh_device(self, device_id):
+        if self.search.busy:
+            # Results are still streaming in; rerun rather than patch them
+            self.filter_devices(keep_position=True)
+        elif self.store.matches(device_id, self.search_entry.get()):
+            self.view.refresh(device_id)
+        else:
+            # A status change can move a ticket out of a "status:" search
+            self.view.remove(device_id)
+            self.update_counter()
+
+    def update_counter(self):
+        text = f"Showing {len(self.view.ids)} of {len(self.store)} devices"
+        if self.search.busy:
+            text += " (searching...)"
+        self.counter_label.config(text=text)
+
+    def sort_treeview(self, col, add=False):
+        # Clicking the sorted column again flips its direction. Sorting is
+        # part of the query, so the order sticks across searches and edits.
+        columns = [c for c, _ in self.sort]
+        if col in columns and (add or len(columns) == 1):
+            index = columns.index(col)
+            self.sort[index] = (col, not self.sort[index][1])
+        elif add:
+            self.sort.append((col, False))
+        else:
+            self.sort = [(col, False)]
+        
+        for c, heading in self.headings.items():
+            self.tree.heading(c, text=heading)
+        for position, (c, descending) in enumerate(self.sort, 1):
+            arrow = "▼" if descending else "▲"
+            suffix = f" {arrow}{position}" if len(self.sort) > 1 else f" {arrow}"
+            self.tree.heading(c, text=self.headings[c] + suffix)
+        self.filter_devices()
+
+    def on_shift_click(self, event):
+        if self.tree.identify_region(event.x, event.y) != "heading":
+            return None
+        col = self.tree["columns"][int(self.tree.identify_column(event.x)[1:]) - 1]
+        self.sort_treeview(col, add=True)
+        return "break"
 
     def export_to_csv(self):
+        filename = f"QueueRepair_Export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        self.start_export(filename)
+
+    def export_as(self):
+        filename = filedialog.asksaveasfilename(
+            title="Export Tickets", defaultextension=".csv", filetypes=FILE_TYPES,
+            initialfile=f"QueueRepair_Export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+        if filename:
+            self.start_export(filename)
+
+    def start_export(self, filename):
+        # Exports what the list currently shows, in its current order, on a
+        # worker thread so the window stays usable
+        if not self.check_loaded():
+            return
+        if self.export_task is not None:
+            messagebox.showinfo("Export", "An export is already running")
+            return
+        
+        ids = list(self.view.ids)
+        self.status_var.set(f"Exporting {len(ids)} tickets...")
+        self.export_task = BackgroundTask(
+            self.root,
+            lambda progress: export_devices(self.queue.tickets(ids), filename, progress=progress),
+            lambda count: self.status_var.set(f"Exporting... {count} of {len(ids)} tickets"),
+            lambda count, error: self.finish_export(filename, count, error))
+
+    def finish_export(self, filename, count, error):
+        self.export_task = None
+        if error is not None:
+            self.status_var.set("Export failed")
+            messagebox.showerror("Export Error", f"Failed to export: {str(error)}")
+            return
+        self.status_var.set(f"Exported {count} tickets to {filename}")
+        messagebox.showinfo("Export Successful", f"Data exported to:\n{os.path.abspath(filename)}")
+
+    def import_tickets(self):
+        if not self.check_loaded():
+            return
+        filename = filedialog.askopenfilename(
+            title="Import Tickets", filetypes=[("Ticket files", "*.csv *.gz *.jsonl")] + FILE_TYPES)
+        if not filename:
+            return
+        
+        self.status_var.set("Reading tickets...")
+        BackgroundTask(
+            self.root,
+            lambda progress: self.queue.parse_import(filename, progress=progress),
+            lambda count: self.status_var.set(f"Reading tickets... {count} valid so far"),
+            lambda result, error: self.finish_import(filename, result, error))
+
+    def finish_import(self, filename, result, error):
+        if error is not None:
+            self.status_var.set("Import failed")
+            messagebox.showerror("Import Error", f"Failed to import: {str(error)}")
+            return
+        
+        devices, errors = result
+        if errors:
+            details = "\n".join(f"Line {line}: {message}" for line, message in errors[:10])
+            if len(errors) > 10:
+                details += f"\n...and {len(errors) - 10} more"
+            if not devices:
+                messagebox.showerror("Import Error", f"No valid tickets found:\n{details}")
+                return
+            if not messagebox.askyesno("Import", f"{len(errors)} rows will be skipped:\n{details}\n\n"
+                                                 f"Import the other {len(devices)} tickets?"):
+                self.status_var.set("Import canceled")
+                return
+        
+        # One batch: a single journal write (or SQLite transaction) for all
         try:
-            filename = f"QueueRepair_Export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-            with open(filename, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow(['ID', 'Device', 'Serial', 'Issue', 'Submitted By', 'Contact', 'Status', 'Date Repaired', 'Date Submitted'])
-                
-                for device in self.devices:
-                    writer.writerow([
-                        device['id'],
-                        device['device'],
-                        device['serial'],
-                        device['issue'],
-                        device['submitted'],
-                        device['contact'],
-                        device['status'],
-                        device['date_repaired'],
-                        device.get('date_submitted', '')
-                    ])
-            
-            self.status_var.set(f"Exported to {filename}")
-            messagebox.showinfo("Export Successful", f"Data exported to:\n{os.path.abspath(filename)}")
+            devices = self.queue.add_imported(devices)
         except Exception as e:
-            messagebox.showerror("Export Error", f"Failed to export: {str(e)}")
+            messagebox.showerror("Import Error", f"Failed to save imported tickets: {str(e)}")
+            return
+        self.filter_devices(keep_position=True)
+        self.status_var.set(f"Imported {len(devices)} tickets from {os.path.basename(filename)}")
 
     def show_dashboard(self):
         # Simple dashboard without matplotlib
+        started = time.perf_counter()
         dashboard = tk.Toplevel(self.root)
         dashboard.title("QueueRepair - Dashboard")
-        dashboard.geometry("600x500")
+        dashboard.geometry("600x660")
         dashboard.configure(bg="#d4d0c8")
         
         # Statistics
-        total = len(self.devices)
-        pending = len([d for d in self.devices if d['status'] == 'Pending'])
-        repaired = len([d for d in self.devices if d['status'] == 'Repaired'])
-        canceled = len([d for d in self.devices if d['status'] == 'Canceled'])
+        # Archived tickets count too; their totals come from the archive
+        # index, no archive segment is opened for this
+        counts = self.store.status_counts()
+        archived = self.queue.archive.summary()
+        counts.update(archived['status_counts'])
+        total = len(self.store) + archived['count']
+        pending = counts['Pending']
+        repaired = counts['Repaired']
+        canceled = counts['Canceled']
         
         # Title
         tk.Label(dashboard, text="Dashboard", font=("Arial", 18, "bold"), 
@@ -332,6 +841,29 @@ class QueueRepairApp:
             tk.Label(dist_frame, text="No data available", bg="#d4d0c8", 
                     font=("Arial", 12)).pack(pady=20)
         
+        # Throughput
+        summary = self.store.stats()
+        throughput_frame = tk.Frame(dashboard, bg="#d4d0c8", relief="raised", bd=2)
+        throughput_frame.pack(fill=tk.X, padx=20, pady=10)
+        
+        tk.Label(throughput_frame, text="Throughput", font=("Arial", 12, "bold"), 
+                bg="#d4d0c8").grid(row=0, column=0, columnspan=2, pady=5)
+        
+        mean_hours = summary['mean_repair_hours']
+        top_list = lambda pairs: ", ".join(f"{name} ({count})" for name, count in pairs) or "-"
+        rows = [
+            ("Avg. time to repair:", f"{mean_hours:.1f} hours" if mean_hours is not None else "-"),
+            ("Submitted today:", str(summary['today'])),
+            ("Submitted this week:", str(summary['this_week'])),
+            ("Top submitters:", top_list(summary['top_submitters'])),
+            ("Top devices:", top_list(summary['top_devices'])),
+            ("Archived:", f"{archived['count']} tickets" + (f", avg. {archived['mean_repair_hours']:.1f} hours to repair"
+                                                          if archived['mean_repair_hours'] is not None else ""))
+        ]
+        for i, (label, value) in enumerate(rows, 1):
+            tk.Label(throughput_frame, text=label, bg="#d4d0c8", anchor="e").grid(row=i, column=0, padx=10, sticky="e")
+            tk.Label(throughput_frame, text=value, bg="#d4d0c8", anchor="w").grid(row=i, column=1, padx=10, sticky="w")
+        
         # Recent activity
         recent_frame = tk.Frame(dashboard, bg="#d4d0c8", relief="raised", bd=2)
         recent_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
@@ -343,39 +875,202 @@ class QueueRepairApp:
         recent_list.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
         
         # Show last 10 repairs
-        for device in sorted(self.devices, key=lambda x: x.get('date_submitted', ''), reverse=True)[:10]:
+        for device in self.store.recent(10):
             recent_list.insert(tk.END, f"[{device['status']}] {device['device']} - {device['issue'][:30]}...")
         
         # Close button
         ttk.Button(dashboard, text="Close", command=dashboard.destroy).pack(pady=10)
+        diagnostics.record("dashboard", time.perf_counter() - started)
+
+    def show_diagnostics(self):
+        # Ctrl+Shift+D. Timings of the slow-prone operations, collected while
+        # diagnostics are on ("diagnostics": true in settings.json, or the
+        # Record box here for this session only)
+        if self.diagnostics_window is not None and self.diagnostics_window.winfo_exists():
+            self.diagnostics_window.lift()
+            return
+        window = tk.Toplevel(self.root)
+        self.diagnostics_window = window
+        window.title("QueueRepair - Diagnostics")
+        window.geometry("640x440")
+        window.configure(bg="#d4d0c8")
+        
+        tk.Label(window, text="Diagnostics", font=("Arial", 14, "bold"), bg="#d4d0c8").pack(pady=10)
+        
+        columns = [
+            ("op", "Operation", 110),
+            ("count", "Count", 60),
+            ("mean", "Mean ms", 75),
+            ("p95", "95% ms", 75),
+            ("max", "Max ms", 75),
+            ("last", "Last ms", 75),
+            ("total", "Total s", 75)
+        ]
+        tree = ttk.Treeview(window, columns=[c for c, _, _ in columns], show="headings", height=11)
+        for col, heading, width in columns:
+            tree.heading(col, text=heading)
+            tree.column(col, width=width, anchor="w" if col == "op" else "e")
+        tree.pack(fill=tk.BOTH, expand=True, padx=20, pady=5)
+        
+        info = tk.Label(window, bg="#d4d0c8", anchor="w", justify="left", wraplength=600)
+        info.pack(fill=tk.X, padx=20, pady=5)
+        
+        def refresh():
+            if not window.winfo_exists():
+                return
+            tree.delete(*tree.get_children())
+            for name, op in diagnostics.summary().items():
+                tree.insert("", "end", values=(name, op['count'], f"{op['mean_ms']:.1f}", f"{op['p95_ms']:.1f}",
+                                               f"{op['max_ms']:.1f}", f"{op['last_ms']:.1f}",
+                                               f"{op['total_ms'] / 1000:.2f}"))
+            if diagnostics.enabled:
+                text = (f"Recording. Anything slower than {diagnostics.slow_ms} ms is logged to "
+                        f"{diagnostics.log_dir / 'diagnostics.log'}")
+                if diagnostics.capture:
+                    text += f" with a {diagnostics.capture} capture"
+            else:
+                text = "Not recording. Tick Record, or put {\"diagnostics\": true} in settings.json to always record."
+            info.config(text=text)
+            window.after(1000, refresh)
+        
+        button_frame = tk.Frame(window, bg="#d4d0c8")
+        button_frame.pack(pady=10)
+        
+        recording = tk.BooleanVar(value=diagnostics.enabled)
+        tk.Checkbutton(button_frame, text="Record", variable=recording, bg="#d4d0c8",
+                      command=lambda: diagnostics.set_enabled(recording.get())).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="Reset", command=lambda: diagnostics.reset()).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="Close", command=window.destroy).pack(side=tk.LEFT, padx=5)
+        refresh()
+
+    def show_duplicates(self):
+        # Every group of tickets that look like one device logged more than
+        # once. The scan runs on a worker thread; double-click a ticket to
+        # jump to it in the list.
+        if not self.check_loaded():
+            return
+        window = tk.Toplevel(self.root)
+        window.title("QueueRepair - Duplicates")
+        window.geometry("760x460")
+        window.configure(bg="#d4d0c8")
+        
+        tk.Label(window, text="Possible Duplicates", font=("Arial", 14, "bold"), bg="#d4d0c8").pack(pady=10)
+        
+        columns = [
+            ("device", "Device Name", 160),
+            ("serial", "Serial Number", 120),
+            ("submitted", "Submitted By", 110),
+            ("status", "Status", 80),
+            ("date_submitted", "Date Submitted", 130)
+        ]
+        tree = ttk.Treeview(window, columns=[c for c, _, _ in columns], height=13)
+        tree.heading("#0", text="Ticket")
+        tree.column("#0", width=120)
+        for col, heading, width in columns:
+            tree.heading(col, text=heading)
+            tree.column(col, width=width, anchor="w")
+        tree.pack(fill=tk.BOTH, expand=True, padx=20, pady=5)
+        
+        info = tk.Label(window, text="Scanning...", bg="#d4d0c8", anchor="w")
+        info.pack(fill=tk.X, padx=20, pady=5)
+        
+        include_closed = tk.BooleanVar()
+        
+        def scan():
+            info.config(text="Scanning...")
+            BackgroundTask(self.root, lambda progress: self.queue.duplicates(include_closed.get()),
+                           lambda progress: None, show)
+        
+        def show(groups, error):
+            if not window.winfo_exists():
+                return
+            if error is not None:
+                info.config(text=f"Scan failed: {error}")
+                return
+            tree.delete(*tree.get_children())
+            for number, devices in enumerate(groups, 1):
+                group = tree.insert("", "end", text=f"Group {number} ({len(devices)})", open=True,
+                                    values=(devices[0]['device'],))
+                for device in devices:
+                    # A ticket can be in more than one group, so Tk picks the iids
+                    tree.insert(group, "end", text=f"#{device['id']}",
+                                values=tuple(device.get(c, "") for c, _, _ in columns))
+            tickets = len({device['id'] for devices in groups for device in devices})
+            info.config(text=f"{len(groups)} groups, {tickets} tickets" if groups else "No duplicates found")
+        
+        def on_double_click(event):
+            item = tree.identify_row(event.y)
+            if item and tree.parent(item):
+                self.show_ticket(int(tree.item(item, "text").lstrip("#")))
+        
+        tree.bind("<Double-1>", on_double_click)
+        
+        button_frame = tk.Frame(window, bg="#d4d0c8")
+        button_frame.pack(pady=10)
+        
+        tk.Checkbutton(button_frame, text="Include closed tickets", variable=include_closed, bg="#d4d0c8",
+                      command=scan).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="Rescan", command=scan).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="Close", command=window.destroy).pack(side=tk.LEFT, padx=5)
+        scan()
+
+    def on_form_key(self, event=None):
+        # Waits for a pause in typing before looking for duplicates
+        if self.duplicate_check is not None:
+            self.root.after_cancel(self.duplicate_check)
+        self.duplicate_check = self.root.after(300, self.check_duplicates)
+
+    def form_matches(self):
+        return self.queue.similar(self.device_entry.get(), self.serial_entry.get(),
+                                  self.submitted_entry.get(), self.contact_entry.get())
+
+    def check_duplicates(self):
+        self.duplicate_check = None
+        if self.loading:
+            return
+        matches = self.form_matches()
+        if not matches:
+            self.duplicate_hint.config(text="")
+            return
+        device, score, reason = matches[0]
+        text = f"Possible duplicate: #{device['id']} {device['device']} ({device['serial'] or 'no serial'}), {reason}"
+        if len(matches) > 1:
+            text += f" and {len(matches) - 1} more"
+        self.duplicate_hint.config(text=text)
+
+    def show_ticket(self, device_id):
+        if not self.view.show(device_id):
+            self.status_var.set(f"Ticket #{device_id} is hidden by the current search")
 
     def add_device(self):
-        device = self.device_entry.get().strip()
-        serial = self.serial_entry.get().strip()
-        issue = self.issue_entry.get().strip()
-        submitted = self.submitted_entry.get().strip()
-        contact = self.contact_entry.get().strip()
-        
-        if not device or not issue:
-            messagebox.showwarning("Input Error", "Device name and issue description are required!")
+        if not self.check_loaded():
             return
-            
-        new_id = max([d['id'] for d in self.devices], default=0) + 1
-        new_device = {
-            "id": new_id,
-            "device": device,
-            "serial": serial,
-            "issue": issue,
-            "submitted": submitted if submitted else "Unknown",
-            "contact": contact,
-            "status": "Pending",
-            "date_submitted": datetime.now().strftime("%Y-%m-%d %H:%M"),
-            "date_repaired": ""
-        }
-        
-        self.devices.append(new_device)
-        self.save_data()
-        self.filter_devices()
+        
+        matches = self.form_matches()
+        if matches:
+            listed = "\n".join(f"#{d['id']} {d['device']} ({d['serial'] or 'no serial'}), {reason}"
+                               for d, score, reason in matches)
+            if not messagebox.askyesno("Possible Duplicate",
+                                       f"These open tickets look like the same device:\n{listed}\n\n"
+                                       f"Add a new ticket anyway?"):
+                self.show_ticket(matches[0][0]['id'])
+                return
+        
+        try:
+            new_device = self.queue.new_ticket(
+                self.device_entry.get(), self.issue_entry.get(), serial=self.serial_entry.get(),
+                submitted=self.submitted_entry.get(), contact=self.contact_entry.get())
+        except ValueError as e:
+            messagebox.showwarning("Input Error", str(e))
+            return
+        new_id = new_device['id']
+        
+        self.save_data(changed=[new_device])
+        if self.search.busy or self.sort:
+            self.filter_devices(keep_position=True)
+        elif self.store.matches(new_id, self.search_entry.get()):
+            self.view.insert(new_id)
+        self.update_counter()
         
         # Clear form
         self.device_entry.delete(0, tk.END)
@@ -383,76 +1078,89 @@ class QueueRepairApp:
         self.issue_entry.delete(0, tk.END)
         self.submitted_entry.delete(0, tk.END)
         self.contact_entry.delete(0, tk.END)
+        self.duplicate_hint.config(text="")
         
-        self.status_var.set(f"Device '{device}' added for repair")
+        self.status_var.set(f"Device '{new_device['device']}' added for repair")
+
+    def set_status(self, status):
+        # Applies a status to every selected ticket in one pass and one save
+        changed = self.queue.change_status(self.view.selection(), status)
+        if changed:
+            self.save_data(changed=changed)
+            if self.search.busy:
+                self.filter_devices(keep_position=True)
+            else:
+                for device in changed:
+                    self.refresh_device(device['id'])
+        return changed
 
     def mark_repaired(self):
-        selected = self.tree.selection()
-        if not selected:
+        if not self.check_loaded():
+            return
+        if not self.view.selection():
             messagebox.showwarning("Selection Error", "Please select a device to mark as repaired")
             return
-            
-        item = self.tree.item(selected[0])
-        device_id = item['values'][0]
+        if not self.active_selection():
+            return
         
-        for device in self.devices:
-            if device['id'] == device_id:
-                if device['status'] == "Repaired":
-                    messagebox.showinfo("Info", "This device is already marked as repaired")
-                    return
-                    
-                device['status'] = "Repaired"
-                device['date_repaired'] = datetime.now().strftime("%Y-%m-%d %H:%M")
-                self.save_data()
-                self.filter_devices()
-                self.status_var.set(f"Device '{device['device']}' marked as repaired")
-                return
+        changed = self.set_status("Repaired")
+        if not changed:
+            messagebox.showinfo("Info", "This device is already marked as repaired")
+        elif len(changed) == 1:
+            self.status_var.set(f"Device '{changed[0]['device']}' marked as repaired")
+        else:
+            self.status_var.set(f"{len(changed)} devices marked as repaired")
 
     def cancel_repair(self):
-        selected = self.tree.selection()
-        if not selected:
+        if not self.check_loaded():
+            return
+        if not self.view.selection():
             messagebox.showwarning("Selection Error", "Please select a device to cancel repair")
             return
-            
-        item = self.tree.item(selected[0])
-        device_id = item['values'][0]
+        if not self.active_selection():
+            return
         
-        for device in self.devices:
-            if device['id'] == device_id:
-                if device['status'] == "Canceled":
-                    messagebox.showinfo("Info", "This repair is already canceled")
-                    return
-                    
-                device['status'] = "Canceled"
-                device['date_repaired'] = datetime.now().strftime("%Y-%m-%d %H:%M")
-                self.save_data()
-                self.filter_devices()
-                self.status_var.set(f"Repair for '{device['device']}' has been canceled")
-                return
+        changed = self.set_status("Canceled")
+        if not changed:
+            messagebox.showinfo("Info", "This repair is already canceled")
+        elif len(changed) == 1:
+            self.status_var.set(f"Repair for '{changed[0]['device']}' has been canceled")
+        else:
+            self.status_var.set(f"{len(changed)} repairs have been canceled")
 
     def delete_device(self):
-        selected = self.tree.selection()
+        if not self.check_loaded():
+            return
+        selected = self.view.selection()
         if not selected:
             messagebox.showwarning("Selection Error", "Please select a device to delete")
             return
-            
-        item = self.tree.item(selected[0])
-        device_id = item['values'][0]
-        device_name = item['values'][1]
+        selected = self.active_selection()
+        if not selected:
+            return
         
-        if not messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete '{device_name}'?"):
+        if len(selected) == 1:
+            device_name = self.store.get(selected[0])['device']
+            prompt = f"Are you sure you want to delete '{device_name}'?"
+        else:
+            prompt = f"Are you sure you want to delete {len(selected)} devices?"
+        if not messagebox.askyesno("Confirm Delete", prompt):
             return
         
-        for device in self.devices:
-            if device['id'] == device_id:
-                self.devices.remove(device)
-                self.save_data()
-                self.filter_devices()
-                self.status_var.set(f"🗑️ Device '{device_name}' has been deleted")
-                return
+        self.save_data(deleted=selected)
+        if self.search.busy:
+            self.filter_devices(keep_position=True)
+        else:
+            self.view.remove(*selected)
+        self.update_counter()
+        
+        if len(selected) == 1:
+            self.status_var.set(f"🗑️ Device '{device_name}' has been deleted")
+        else:
+            self.status_var.set(f"🗑️ {len(selected)} devices have been deleted")
 
     def load_treeview(self):
-        self.filter_devices()
+        self.filter_devices(keep_position=True)
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -0,0 +1,241 @@
+import gzip
+import json
+import os
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from queuerepair_lock import FileLock
+from queuerepair_metrics import Metrics, parse_date
+from queuerepair_search import GRAM, SearchIndex, parse_query, sort_key
+from queuerepair_ticket import plain
+
+ARCHIVE_STATUSES = ("Repaired", "Canceled")
+
+
+def closed_on(device):
+    return parse_date(device.get('date_repaired', '')) or parse_date(device.get('date_submitted', ''))
+
+
+def is_archivable(device, cutoff):
+    if device['status'] not in ARCHIVE_STATUSES:
+        return False
+    closed = closed_on(device)
+    return closed is not None and closed < cutoff
+
+
+def sort_records(ids, records, spec):
+    # Same ordering rules as SortEngine, for records that aren't in a store
+    for column, descending in reversed(spec or ()):
+        ids.sort(key=lambda i: sort_key(column, records[i].get(column)), reverse=descending)
+    return ids
+
+
+class Archive:
+    # Closed tickets moved out of the working set. Each month they were
+    # closed in gets its own gzip'd JSON Lines segment (archive/2024-03.jsonl.gz)
+    # and archive/index.json keeps every segment's id range and dashboard
+    # totals, so counts come from the index and a segment is only opened
+    # when a search or lookup actually needs it. Searching keeps a small
+    # search-only index of every segment in memory; the records themselves
+    # are read for the hits not fetched by an earlier search.
+
+    def __init__(self, data_dir, cache_size=8):
+        self.dir = Path(data_dir) / "archive"
+        self.index_file = self.dir / "index.json"
+        self.cache_size = cache_size
+        self.index = {}
+        self.hits = {}
+        self._index_mtime = None
+        self._segments = OrderedDict()
+        self._indexes = {}
+        self._lock = threading.RLock()
+        self._file_lock = None
+
+    def lock(self):
+        if self._file_lock is None:
+            self.dir.mkdir(exist_ok=True)
+            self._file_lock = FileLock(self.dir / "archive.lock")
+        return self._file_lock
+
+    def refresh(self):
+        # Cheap when nothing changed; picks up segments other instances wrote
+        with self._lock:
+            try:
+                mtime = os.stat(self.index_file).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime == self._index_mtime:
+                return self.index
+            self.index = {}
+            if mtime is not None:
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    self.index = json.load(f)
+            self._index_mtime = mtime
+            self._segments.clear()
+            self._indexes.clear()
+            self.hits.clear()
+            return self.index
+
+    def __len__(self):
+        return sum(entry['count'] for entry in self.refresh().values())
+
+    def segment_file(self, name):
+        return self.dir / f"{name}.jsonl.gz"
+
+    def read_segment(self, name):
+        path = self.segment_file(name)
+        if not path.exists():
+            return {}
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            records = (json.loads(line) for line in f if line.strip())
+            return {device['id']: device for device in records}
+
+    def write_segment(self, name, records):
+        path = self.segment_file(name)
+        tmp_file = path.with_name(path.name + ".tmp")
+        with gzip.open(tmp_file, 'wt', encoding='utf-8') as f:
+            for device in records.values():
+                f.write(json.dumps(device, ensure_ascii=False, default=plain) + "\n")
+        os.replace(tmp_file, path)
+
+    def summarize(self, records):
+        metrics = Metrics(records.values())
+        return {
+            "count": len(records),
+            "min_id": min(records),
+            "max_id": max(records),
+            "status": dict(+metrics.status),
+            "repair_minutes": metrics.repair_minutes,
+            "repaired_timed": metrics.repaired_timed,
+            "submitters": dict(+metrics.submitters),
+            "devices": dict(+metrics.devices),
+        }
+
+    def _rewrite(self, changes):
+        # changes maps segment name -> (records to add, ids to drop)
+        with self.lock():
+            index = dict(self.refresh())
+            for name, (added, dropped) in changes.items():
+                records = self.read_segment(name)
+                records.update((d['id'], d) for d in added)
+                for device_id in dropped:
+                    records.pop(device_id, None)
+                if records:
+                    self.write_segment(name, records)
+                    index[name] = self.summarize(records)
+                else:
+                    self.segment_file(name).unlink(missing_ok=True)
+                    index.pop(name, None)
+            tmp_file = self.index_file.with_name(self.index_file.name + ".tmp")
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(dict(sorted(index.items())), f, indent=2)
+            os.replace(tmp_file, self.index_file)
+            self.refresh()
+
+    def add(self, devices):
+        changes = {}
+        for device in devices:
+            name = closed_on(device).strftime("%Y-%m")
+            changes.setdefault(name, ([], []))[0].append(device)
+        if changes:
+            self._rewrite(changes)
+
+    def take(self, device_ids):
+        # Removes tickets from the archive and returns them
+        taken = []
+        changes = {}
+        for device_id in device_ids:
+            for name in self.segments_for(device_id):
+                device = self._segment(name).get(device_id)
+                if device is not None:
+                    taken.append(device)
+                    changes.setdefault(name, ([], []))[1].append(device_id)
+        if changes:
+            self._rewrite(changes)
+        return taken
+
+    def segments_for(self, device_id):
+        return [name for name, entry in self.refresh().items()
+                if entry['min_id'] <= device_id <= entry['max_id']]
+
+    def _segment(self, name):
+        with self._lock:
+            records = self._segments.get(name)
+            if records is None:
+                records = self._segments[name] = self.read_segment(name)
+                while len(self._segments) > self.cache_size:
+                    self._segments.popitem(last=False)
+            self._segments.move_to_end(name)
+            return records
+
+    def _search_index(self, name):
+        # (index, ids) of a segment, built once per version of the archive
+        with self._lock:
+            found = self._indexes.get(name)
+            if found is None:
+                records = self._segment(name)
+                found = self._indexes[name] = (SearchIndex(records.values(), docs=False), list(records))
+            return found
+
+    def get(self, device_id):
+        device = self.hits.get(device_id)
+        if device is not None:
+            return device
+        for name in self.segments_for(device_id):
+            device = self._segment(name).get(device_id)
+            if device is not None:
+                return device
+        return None
+
+    def _may_match(self, entry, status_terms):
+        # Skips whole segments a "status:" filter rules out, e.g. every
+        # segment for "status:pending"
+        statuses = [status.lower() for status in entry['status']]
+        return all(any(s.startswith(t) if len(t) < GRAM else t in s for s in statuses)
+                   for t in status_terms)
+
+    def search(self, query, sort=None, exclude=(), cancelled=None):
+        # Matching archived ids, newest segment first. Tickets that are also
+        # in the working set (exclude) are left out; that copy is current.
+        status_terms = [term for fields, term in parse_query(query) if fields == ("status",)]
+        found = {}
+        for name, entry in sorted(self.refresh().items(), reverse=True):
+            if status_terms and not self._may_match(entry, status_terms):
+                continue
+            if cancelled is not None and cancelled():
+                return []
+            index, ids = self._search_index(name)
+            hits = index.search(query)
+            wanted = [i for i in (ids if hits is None else hits) if i not in exclude]
+            missing = [i for i in wanted if i not in self.hits]
+            if missing:
+                records = self._segment(name)
+                self.hits.update((i, records[i]) for i in missing)
+            found.update((i, self.hits[i]) for i in wanted)
+        return sort_records(sorted(found), found, sort)
+
+    def summary(self, top=3):
+        status = Counter()
+        submitters = Counter()
+        devices = Counter()
+        minutes = 0.0
+        timed = 0
+        for entry in self.refresh().values():
+            status.update(entry['status'])
+            submitters.update(entry['submitters'])
+            devices.update(entry['devices'])
+            minutes += entry['repair_minutes']
+            timed += entry['repaired_timed']
+        return {
+            "count": sum(status.values()),
+            "status_counts": status,
+            "mean_repair_hours": minutes / timed / 60 if timed else None,
+            "top_submitters": submitters.most_common(top),
+            "top_devices": devices.most_common(top),
+        }
+
+
+def archive_cutoff(days, now=None):
+    return (now or datetime.now()) - timedelta(days=days)
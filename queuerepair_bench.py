@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from queuerepair_core import SORT_FIELDS, RepairQueue
+from queuerepair_search import DATE_FORMAT
+
+# Times the operations that slow down as the queue grows (loading, saving,
+# searching, sorting by each column, the dashboard and CSV export) on
+# synthetic data, and prints the results as JSON so runs from different
+# versions can be compared, e.g.
+#   python queuerepair_bench.py --sizes 10000 100000 > before.json
+#   python queuerepair_bench.py --sizes 1000000 --storage json sqlite
+#   python queuerepair_bench.py --generate --count 50000 --data-dir TestData
+# Only the headless core is used. --gui also times drawing the ticket list,
+# which needs a display (xvfb-run works).
+
+DEVICES = [
+    "Dell Latitude 5420", "Dell OptiPlex 7090", "HP EliteBook 840", "HP ProBook 450", "Lenovo ThinkPad T14",
+    "Lenovo ThinkCentre M720", "MacBook Air", "MacBook Pro 14", "Surface Pro 7", "Surface Laptop 4",
+    "iPad 9th Gen", "Brother HL-L2350", "HP LaserJet M404", "Epson EcoTank", "Cisco IP Phone 8841",
+]
+ISSUES = [
+    "Screen flickers", "No power", "Keyboard broken", "Battery swelling", "Won't boot", "Cracked screen",
+    "Overheating", "Wi-Fi keeps dropping", "Paper jam", "Fan noise", "Blue screen on startup",
+    "Trackpad not responding", "Charging port loose", "Slow performance", "No sound",
+]
+SUBMITTERS = [
+    "Front Desk", "Alice Johnson", "Bob Smith", "Carol White", "David Brown", "Emma Davis",
+    "Frank Miller", "Grace Wilson", "Henry Moore", "Isabel Taylor", "Jack Anderson", "Unknown",
+]
+# Roughly what a busy queue looks like: most tickets are closed
+STATUS_WEIGHTS = (("Pending", 25), ("Repaired", 65), ("Canceled", 10))
+SEARCHES = ["dell", "status:pending", "serial:SN12", "keyboard broken", "submitted:front", "contact:example"]
+
+
+def generate_tickets(count, seed=0, now=None, days=730):
+    # Tickets shaped like the ones add_device creates, submitted over the
+    # last `days` days in id order
+    rng = random.Random(seed)
+    now = now or datetime.now()
+    start = now - timedelta(days=days)
+    step = timedelta(days=days) / max(count, 1)
+    statuses = [status for status, weight in STATUS_WEIGHTS for _ in range(weight)]
+    for device_id in range(1, count + 1):
+        submitted_at = start + step * device_id - timedelta(minutes=rng.randrange(60))
+        status = rng.choice(statuses)
+        repaired = ""
+        if status != "Pending":
+            closed = min(submitted_at + timedelta(minutes=rng.randrange(30, 60 * 24 * 14)), now)
+            repaired = closed.strftime(DATE_FORMAT)
+        submitter = SUBMITTERS[min(int(rng.expovariate(0.4)), len(SUBMITTERS) - 1)]
+        contact = ""
+        if rng.random() < 0.7:
+            contact = rng.choice([f"{submitter.split()[0].lower()}@example.com",
+                                  f"555-{rng.randrange(10000):04d}", f"ext. {rng.randrange(100, 999)}"])
+        yield {
+            "id": device_id,
+            "device": rng.choice(DEVICES),
+            "serial": rng.choice(["SN", "CN", "PF", ""]) + f"{rng.randrange(16 ** 8):08X}",
+            "issue": rng.choice(ISSUES),
+            "submitted": submitter,
+            "contact": contact,
+            "status": status,
+            "date_submitted": submitted_at.strftime(DATE_FORMAT),
+            "date_repaired": repaired,
+        }
+
+
+def write_dataset(data_dir, count, seed=0, storage="json"):
+    # Writes repair_data.json the way the app does, streamed so a million
+    # tickets don't have to be held in memory first
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    with open(data_dir / "repair_data.json", 'w', encoding='utf-8') as f:
+        f.write("[")
+        for i, device in enumerate(generate_tickets(count, seed)):
+            f.write(("," if i else "") + json.dumps(device))
+        f.write("]")
+    with open(data_dir / "repair_meta.json", 'w', encoding='utf-8') as f:
+        json.dump({"next_id": count + 1}, f)
+    if storage != "json":
+        with open(data_dir / "settings.json", 'w', encoding='utf-8') as f:
+            json.dump({"storage": storage}, f)
+    return data_dir
+
+
+def timed(fn, repeat=1):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return result, samples
+
+
+def report(samples, **extra):
+    entry = {"runs": len(samples), "min_ms": round(min(samples) * 1000, 3),
+             "median_ms": round(statistics.median(samples) * 1000, 3)}
+    entry.update(extra)
+    return entry
+
+
+def peak_memory_mb():
+    # Linux keeps ru_maxrss across exec, so a child started from a big
+    # process would report the parent's peak; VmHWM starts over
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+
+def load_peak_memory_mb(data_dir):
+    # Peak memory of a fresh process that only loads the queue. The process
+    # peak of this one only ever rises, so it would carry the repeated loads
+    # and earlier sizes and storages along.
+    code = ("import sys; from queuerepair_core import RepairQueue; from queuerepair_bench import peak_memory_mb; "
+            "RepairQueue(sys.argv[1]).open(); print(peak_memory_mb())")
+    output = subprocess.run([sys.executable, "-c", code, str(data_dir)], cwd=Path(__file__).resolve().parent,
+                            capture_output=True, text=True, check=True).stdout.strip()
+    return None if output == "None" else float(output)
+
+
+def bench_size(count, storage, args, work_dir):
+    data_dir = work_dir / f"{storage}-{count}"
+    results = {"records": count, "storage": storage}
+
+    _, samples = timed(lambda: write_dataset(data_dir, count, args.seed, storage))
+    results['generate'] = report(samples)
+    if storage == "sqlite":
+        # First open copies the JSON data into repair_data.db
+        _, samples = timed(lambda: RepairQueue(data_dir).open().close())
+        results['migrate'] = report(samples)
+
+    # Each run's queue is let go before the next load, so only one is in
+    # memory at a time
+    samples = []
+    queue = None
+    for _ in range(args.repeat):
+        if queue is not None:
+            queue.close()
+            queue = None
+        start = time.perf_counter()
+        queue = RepairQueue(data_dir).open()
+        samples.append(time.perf_counter() - start)
+    results['load'] = report(samples, tickets=len(queue.store), peak_memory_mb=load_peak_memory_mb(data_dir))
+    store = queue.store
+
+    searches = {}
+    for query in SEARCHES:
+        ids, samples = timed(lambda: queue.search(query), args.repeat)
+        searches[query] = report(samples, matches=len(ids))
+    results['search'] = searches
+
+    sorts = {}
+    for column in SORT_FIELDS:
+        sorter = getattr(store, "sorter", None)
+        if sorter is not None:
+            sorter.clear()
+        _, cold = timed(lambda: queue.search("", [(column, False)]))
+        _, warm = timed(lambda: queue.search("", [(column, True)]), args.repeat)
+        sorts[column] = {"first": report(cold), "again": report(warm)}
+    results['sort'] = sorts
+
+    def dashboard():
+        # What the Dashboard window reads
+        counts = store.status_counts()
+        counts.update(queue.archive.summary()['status_counts'])
+        return queue.stats(), store.recent(10)
+
+    _, samples = timed(dashboard, args.repeat)
+    results['dashboard'] = report(samples)
+
+    export_file = data_dir / "export.csv"
+    exported, samples = timed(lambda: queue.export(export_file), args.repeat)
+    results['export_csv'] = report(samples, rows=exported, bytes=os.path.getsize(export_file))
+
+    # A technician marking one ticket repaired, then (JSON store only) the
+    # full rewrite it does in the background every so often. SQLite writes
+    # each change in place and has no such rewrite to time.
+    ids = store.ids()
+    rng = random.Random(args.seed)
+    picks = iter([rng.choice(ids) for _ in range(args.repeat * 2)])
+
+    def save_one():
+        device_id = next(picks)
+        status = "Pending" if store.get(device_id)['status'] != "Pending" else "Repaired"
+        queue.set_status([device_id], status)
+
+    _, samples = timed(save_one, args.repeat * 2)
+    results['save_one'] = report(samples)
+    if storage != "sqlite":
+        _, samples = timed(lambda: store.compact(wait=True))
+        results['save_all'] = report(samples)
+
+    if args.gui:
+        results['render'] = bench_render(queue, args.repeat)
+
+    queue.close()
+    if not args.keep:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return results
+
+
+def bench_render(queue, repeat):
+    # The ticket list as the app draws it: handing over every id, then
+    # scrolling a page at a time
+    import tkinter as tk
+    from tkinter import ttk
+    from queuerepair import VirtualTreeview
+
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        return {"skipped": f"no display ({e})"}
+    root.withdraw()
+    try:
+        columns = ("id", "device", "serial", "issue", "submitted", "contact", "status", "date_repaired")
+        tree = ttk.Treeview(root, columns=columns, show="headings", height=15)
+        scrollbar = ttk.Scrollbar(root, orient="vertical")
+        store = queue.store
+        view = VirtualTreeview(tree, scrollbar, lambda i: tuple(store.get(i)[c] for c in columns))
+        ids = store.ids()
+
+        def fill():
+            view.set_ids(ids)
+            root.update_idletasks()
+
+        def scroll():
+            for _ in range(50):
+                view.scroll(view.page)
+            root.update_idletasks()
+
+        _, filled = timed(fill, repeat)
+        _, scrolled = timed(scroll, repeat)
+        return {"fill": report(filled, rows=len(ids)), "scroll_50_pages": report(scrolled)}
+    finally:
+        root.destroy()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="queuerepair-bench", description="Benchmarks for QueueRepair")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000],
+                        help="ticket counts to test (default: 10000 100000)")
+    parser.add_argument("--storage", nargs="+", choices=("json", "sqlite"), default=["json"])
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement (default: 3)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--gui", action="store_true", help="also time drawing the list (needs a display)")
+    parser.add_argument("--work-dir", help="where to put the datasets (default: a temporary folder)")
+    parser.add_argument("--keep", action="store_true", help="leave the datasets behind")
+    parser.add_argument("--generate", action="store_true", help="only write a dataset of --count tickets to --data-dir")
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--data-dir", default="QueueRepairData")
+    args = parser.parse_args(argv)
+
+    if args.generate:
+        if (Path(args.data_dir) / "repair_data.json").exists():
+            parser.error(f"{args.data_dir} already has tickets; pick an empty folder")
+        write_dataset(args.data_dir, args.count, args.seed, args.storage[0])
+        print(f"Wrote {args.count} tickets to {args.data_dir}")
+        return 0
+
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix="queuerepair-bench-"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        runs = [bench_size(count, storage, args, work_dir) for storage in args.storage for count in args.sizes]
+    finally:
+        if not args.work_dir and not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps({
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": datetime.now().strftime(DATE_FORMAT),
+        "repeat": args.repeat,
+        "runs": runs,
+    }, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
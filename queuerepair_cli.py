@@ -0,0 +1,236 @@
+import argparse
+import json
+import sys
+
+from queuerepair_core import EDITABLE_FIELDS, RepairQueue, parse_sort
+from queuerepair_export import STATUSES
+from queuerepair_ticket import plain
+
+# Command line for the repair queue, e.g.
+#   python queuerepair_cli.py add "Dell Latitude" "Screen flickers" --serial ABC123
+#   python queuerepair_cli.py search "serial:abc status:pending"
+#   python queuerepair_cli.py update 12 13 --status Repaired
+#   python queuerepair_cli.py export pending.csv.gz --query status:pending
+#   python queuerepair_cli.py duplicates --serial "S/N ABC-123"
+# It never imports tkinter, so it runs on headless servers and in cron jobs.
+
+LIST_COLUMNS = [
+    ("id", "ID", 6),
+    ("device", "Device", 20),
+    ("serial", "Serial", 14),
+    ("issue", "Issue", 30),
+    ("submitted", "Submitted By", 14),
+    ("status", "Status", 9),
+    ("date_submitted", "Submitted", 16),
+]
+
+
+def print_tickets(tickets, output):
+    if output == "jsonl":
+        for ticket in tickets:
+            print(json.dumps(ticket, ensure_ascii=False, default=plain))
+        return
+    if output == "json":
+        print(json.dumps(list(tickets), indent=2, ensure_ascii=False, default=plain))
+        return
+
+    def cell(value, width):
+        text = str(value).replace("\n", " ")
+        return text if len(text) <= width else text[:width - 3] + "..."
+
+    print("  ".join(heading.ljust(width) for _, heading, width in LIST_COLUMNS).rstrip())
+    for ticket in tickets:
+        print("  ".join(cell(ticket.get(field, ''), width).ljust(width)
+                        for field, _, width in LIST_COLUMNS).rstrip())
+
+
+def warn_similar(matches):
+    for ticket, score, reason in matches:
+        print(f"warning: open ticket {ticket['id']} ({ticket['device']}, {ticket['serial'] or 'no serial'}) "
+              f"looks like the same device: {reason}", file=sys.stderr)
+
+
+def cmd_add(queue, args):
+    # Still adds the ticket; the warning is for whoever is logging it
+    warn_similar(queue.similar(args.device, args.serial, args.submitted, args.contact))
+    ticket = queue.add(args.device, args.issue, serial=args.serial,
+                       submitted=args.submitted, contact=args.contact)
+    print(ticket['id'])
+
+
+def cmd_list(queue, args):
+    query = getattr(args, "query", "")
+    if args.status:
+        query += f" status:{args.status}"
+    ids = queue.search(query, parse_sort(args.sort), include_archive=args.archive)
+    if args.limit:
+        ids = ids[:args.limit]
+    print_tickets(queue.tickets(ids), args.output)
+
+
+def cmd_update(queue, args):
+    fields = {field: getattr(args, field) for field in EDITABLE_FIELDS if getattr(args, field) is not None}
+    if not fields and not args.status:
+        raise ValueError("Nothing to update (give --status or a field to change)")
+    for device_id in args.ids:
+        if queue.get(device_id) is None:
+            raise ValueError(f"No ticket with ID {device_id}")
+    for device_id in args.ids:
+        if fields:
+            queue.edit(device_id, **fields)
+    if args.status:
+        changed = queue.set_status(args.ids, args.status)
+        print(f"{len(changed)} ticket(s) set to {args.status}")
+
+
+def cmd_delete(queue, args):
+    removed = queue.delete(args.ids)
+    print(f"{len(removed)} ticket(s) deleted")
+
+
+def cmd_export(queue, args):
+    count = queue.export(args.path, args.query, parse_sort(args.sort), fmt=args.format,
+                         include_archive=args.archive)
+    print(f"Exported {count} tickets to {args.path}")
+
+
+def cmd_import(queue, args):
+    added, errors = queue.import_file(args.path, fmt=args.format)
+    for line, message in errors:
+        print(f"line {line}: {message}", file=sys.stderr)
+    print(f"Imported {len(added)} tickets, skipped {len(errors)}")
+
+
+def cmd_stats(queue, args):
+    stats = queue.stats()
+    if args.json:
+        print(json.dumps(stats, indent=2))
+        return
+    mean = stats['mean_repair_hours']
+    print(f"Total tickets:       {stats['total']}")
+    for status in STATUSES:
+        print(f"{status + ':':<21}{stats[status.lower()]}")
+    print(f"Archived:            {stats['archived']}")
+    print(f"Avg. time to repair: {f'{mean:.1f} hours' if mean is not None else '-'}")
+    print(f"Submitted today:     {stats['today']}")
+    print(f"Submitted this week: {stats['this_week']}")
+    for label, key in (("Top submitters:", "top_submitters"), ("Top devices:", "top_devices")):
+        print(f"{label:<21}" + (", ".join(f"{name} ({count})" for name, count in stats[key]) or "-"))
+
+
+def cmd_duplicates(queue, args):
+    if args.device or args.serial or args.submitted or args.contact:
+        # Checks one device before it is logged
+        matches = queue.similar(args.device, args.serial, args.submitted, args.contact, limit=args.limit)
+        if args.output == "json":
+            print(json.dumps([dict(ticket, score=round(score, 3), reason=reason) for ticket, score, reason in matches],
+                             indent=2, ensure_ascii=False, default=plain))
+            return
+        for ticket, score, reason in matches:
+            print(f"{ticket['id']:<6}  {score:.2f}  {reason:<23}  {ticket['device']}  {ticket['serial']}".rstrip())
+        return
+    groups = queue.duplicates(include_closed=args.all)
+    if args.output == "json":
+        print(json.dumps(groups, indent=2, ensure_ascii=False, default=plain))
+        return
+    for number, tickets in enumerate(groups, 1):
+        if number > 1:
+            print()
+        print(f"Group {number}: {len(tickets)} tickets")
+        print_tickets(tickets, "table")
+    print(f"{len(groups)} group(s) of possible duplicates", file=sys.stderr)
+
+
+def cmd_archive(queue, args):
+    if args.restore:
+        restored = queue.restore(args.restore)
+        print(f"{len(restored)} ticket(s) restored from the archive")
+        return
+    moved = queue.archive_closed(args.days)
+    print(f"{len(moved)} closed ticket(s) older than {queue.archive_days(args.days)} days archived")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="queuerepair", description="QueueRepair - IT Repair Tracker (command line)")
+    parser.add_argument("--data-dir", default="QueueRepairData", help="data folder (default: QueueRepairData)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="add a device for repair")
+    add.add_argument("device")
+    add.add_argument("issue")
+    add.add_argument("--serial", default="")
+    add.add_argument("--submitted", default="")
+    add.add_argument("--contact", default="")
+    add.set_defaults(func=cmd_add)
+
+    for name, help_text in (("list", "list tickets"), ("search", "search tickets")):
+        sub = commands.add_parser(name, help=help_text)
+        if name == "search":
+            sub.add_argument("query", help='e.g. "dell serial:abc status:pending"')
+        sub.add_argument("--status", choices=[s.lower() for s in STATUSES], type=str.lower)
+        sub.add_argument("--sort", action="append", metavar="COLUMN[:desc]")
+        sub.add_argument("--limit", type=int)
+        sub.add_argument("--output", choices=("table", "json", "jsonl"), default="table")
+        sub.add_argument("--archive", action="store_true", help="include archived tickets")
+        sub.set_defaults(func=cmd_list)
+
+    update = commands.add_parser("update", help="change status or details of tickets")
+    update.add_argument("ids", type=int, nargs="+")
+    update.add_argument("--status", choices=STATUSES, type=str.capitalize)
+    for field in EDITABLE_FIELDS:
+        update.add_argument(f"--{field}")
+    update.set_defaults(func=cmd_update)
+
+    delete = commands.add_parser("delete", help="delete tickets")
+    delete.add_argument("ids", type=int, nargs="+")
+    delete.set_defaults(func=cmd_delete)
+
+    export = commands.add_parser("export", help="export tickets to .csv, .csv.gz or .jsonl")
+    export.add_argument("path")
+    export.add_argument("--query", default="")
+    export.add_argument("--sort", action="append", metavar="COLUMN[:desc]")
+    export.add_argument("--format", choices=("csv", "csv.gz", "jsonl"))
+    export.add_argument("--archive", action="store_true", help="include archived tickets")
+    export.set_defaults(func=cmd_export)
+
+    import_ = commands.add_parser("import", help="import tickets from .csv, .csv.gz or .jsonl")
+    import_.add_argument("path")
+    import_.add_argument("--format", choices=("csv", "csv.gz", "jsonl"))
+    import_.set_defaults(func=cmd_import)
+
+    archive = commands.add_parser("archive", help="move old closed tickets to the archive")
+    archive.add_argument("--days", type=int, help="closed more than this many days ago "
+                                                  "(default: archive_after_days in settings.json, or 90)")
+    archive.add_argument("--restore", type=int, nargs="+", metavar="ID", help="move tickets back out of the archive")
+    archive.set_defaults(func=cmd_archive)
+
+    duplicates = commands.add_parser("duplicates", help="find tickets logged more than once for the same device")
+    duplicates.add_argument("--all", action="store_true", help="include closed tickets")
+    duplicates.add_argument("--output", choices=("table", "json"), default="table")
+    duplicates.add_argument("--limit", type=int, default=5, help="matches to show with --serial/--device")
+    for field in ("device", "serial", "submitted", "contact"):
+        duplicates.add_argument(f"--{field}", default="", help="check one device instead of the whole queue")
+    duplicates.set_defaults(func=cmd_duplicates)
+
+    stats = commands.add_parser("stats", help="show dashboard numbers")
+    stats.add_argument("--json", action="store_true")
+    stats.set_defaults(func=cmd_stats)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        # Each command runs once, so only the index it asks for gets built
+        # (search for list/search/export, dashboard for stats, duplicates
+        # for add and duplicates) instead of all of them on load
+        with RepairQueue(args.data_dir, indexed=False) as queue:
+            args.func(queue, args)
+    except (ValueError, OSError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+from datetime import datetime
+from pathlib import Path
+
+from queuerepair_archive import Archive, archive_cutoff, is_archivable
+from queuerepair_diagnostics import diagnostics
+from queuerepair_dupes import OPEN_STATUSES
+from queuerepair_export import STATUSES, export_devices, import_devices
+from queuerepair_search import DATE_FORMAT, QUERY_FIELDS
+from queuerepair_store import load_settings, open_store
+
+EDITABLE_FIELDS = ("device", "serial", "issue", "submitted", "contact")
+ARCHIVE_AFTER_DAYS = 90
+SORT_FIELDS = QUERY_FIELDS + ("id", "date_submitted", "date_repaired")
+
+
+def parse_sort(values):
+    # ["date_submitted:desc", "device"] -> [(column, descending)]
+    spec = []
+    for value in values or ():
+        column, _, direction = value.strip().partition(":")
+        if column not in SORT_FIELDS:
+            raise ValueError(f"Can't sort by '{column}'")
+        spec.append((column, direction.lower() in ("desc", "d", "-")))
+    return spec
+
+
+class RepairQueue:
+    # The repair queue without any GUI: ticket rules (required fields,
+    # defaults, status dates) on top of whichever store is configured. The
+    # Tk app and the command line both go through this; errors are raised
+    # as ValueError for bad input and left to the caller to present.
+
+    def __init__(self, data_dir="QueueRepairData", store=None, indexed=True):
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(exist_ok=True)
+        self.settings = load_settings(self.data_dir)
+        diagnostics.configure(self.data_dir, self.settings)
+        # An empty store is falsy (len 0), so test for None
+        self.store = store if store is not None else open_store(self.data_dir, indexed)
+        self.archive = Archive(self.data_dir)
+
+    def open(self):
+        with diagnostics.measure("load"):
+            self.store.load()
+        return self
+
+    def close(self):
+        self.store.close()
+        diagnostics.flush()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def new_ticket(self, device, issue, serial="", submitted="", contact="", device_id=None):
+        device = device.strip()
+        issue = issue.strip()
+        if not device or not issue:
+            raise ValueError("Device name and issue description are required!")
+        return {
+            "id": self.store.allocate_id() if device_id is None else device_id,
+            "device": device,
+            "serial": serial.strip(),
+            "issue": issue,
+            "submitted": submitted.strip() or "Unknown",
+            "contact": contact.strip(),
+            "status": "Pending",
+            "date_submitted": datetime.now().strftime(DATE_FORMAT),
+            "date_repaired": ""
+        }
+
+    def change_status(self, device_ids, status):
+        # Updates the records in place and returns the ones that changed;
+        # the caller saves them (in one batch) with save()
+        self.check_status(status)
+        changed = []
+        for device_id in device_ids:
+            device = self.store.get(device_id)
+            if device is not None and self.apply_status(device, status):
+                changed.append(device)
+        return changed
+
+    def check_status(self, status):
+        if status not in STATUSES:
+            raise ValueError(f"Unknown status '{status}' (use {', '.join(STATUSES)})")
+
+    def apply_status(self, device, status):
+        if device['status'] == status:
+            return False
+        device['status'] = status
+        device['date_repaired'] = "" if status == "Pending" else datetime.now().strftime(DATE_FORMAT)
+        return True
+
+    def save(self, changed=(), deleted=()):
+        removed = []
+        with diagnostics.measure("save", changed=len(changed), deleted=len(deleted)):
+            try:
+                if changed:
+                    self.store.update(changed)
+            finally:
+                # A conflict on an edit doesn't stop the deletes going through
+                if deleted:
+                    removed = self.store.delete(deleted)
+        return removed
+
+    def add(self, device, issue, serial="", submitted="", contact=""):
+        ticket = self.new_ticket(device, issue, serial, submitted, contact)
+        self.save(changed=[ticket])
+        return ticket
+
+    def set_status(self, device_ids, status):
+        changed = self.change_status(device_ids, status)
+        self.save(changed=changed)
+        return changed
+
+    def edit(self, device_id, **fields):
+        device = self.apply_edit(device_id, **fields)
+        self.save(changed=[device])
+        return device
+
+    def apply_edit(self, device_id, **fields):
+        # Like change_status: updates the record in place, the caller saves
+        device = self.store.get(device_id)
+        if device is None:
+            raise ValueError(f"No ticket with ID {device_id}")
+        edited = dict(device)
+        for field, value in fields.items():
+            if field not in EDITABLE_FIELDS:
+                raise ValueError(f"Field '{field}' can't be edited")
+            edited[field] = value.strip()
+        if not edited['device'] or not edited['issue']:
+            raise ValueError("Device name and issue description are required!")
+        edited['submitted'] = edited['submitted'] or "Unknown"
+        device.update(edited)
+        return device
+
+    def delete(self, device_ids):
+        return self.save(deleted=device_ids)
+
+    def get(self, device_id):
+        return self.store.get(device_id)
+
+    def poll(self):
+        # Picks up tickets other instances sharing the data folder changed;
+        # see DeviceStore.poll
+        return self.store.poll()
+
+    def similar(self, device="", serial="", submitted="", contact="", exclude=None, limit=5):
+        # Open tickets that look like the same device as the one about to be
+        # added (or edited, pass its id as exclude): [(ticket, score, reason)]
+        # best first, score 1.0 meaning the same serial
+        matches = self.store.similar(serial, device, submitted, contact, OPEN_STATUSES, exclude, limit)
+        return [(self.store.get(device_id), score, reason) for device_id, score, reason in matches]
+
+    def duplicates(self, include_closed=False):
+        # Groups of tickets that look like one device logged more than once
+        clusters = self.store.duplicate_clusters(None if include_closed else OPEN_STATUSES)
+        return [list(self.store.iter_records(ids)) for ids in clusters]
+
+    def search(self, query="", sort=None, include_archive=False, cancelled=None):
+        # Archived matches come after the working set, in the same order
+        ids = self.store.search(query, sort, cancelled)
+        if include_archive:
+            ids += self.archive.search(query, sort, exclude=self.store, cancelled=cancelled)
+        return ids
+
+    def tickets(self, device_ids):
+        if not self.archive.hits:
+            return self.store.iter_records(device_ids)
+        return self._tickets_with_archive(list(device_ids))
+
+    def _tickets_with_archive(self, device_ids, batch_size=500):
+        for start in range(0, len(device_ids), batch_size):
+            chunk = device_ids[start:start + batch_size]
+            current = {d['id']: d for d in self.store.iter_records(chunk)}
+            for device_id in chunk:
+                device = current.get(device_id) or self.archive.get(device_id)
+                if device is not None:
+                    yield device
+
+    def stats(self):
+        with diagnostics.measure("dashboard"):
+            counts = self.store.status_counts()
+            summary = {"total": len(self.store)}
+            summary.update({status.lower(): counts[status] for status in STATUSES})
+            summary.update(self.store.stats())
+            summary['archived'] = len(self.archive)
+        return summary
+
+    def export(self, path, query="", sort=None, fmt=None, progress=None, include_archive=False):
+        ids = self.search(query, sort, include_archive)
+        return export_devices(self.tickets(ids), path, fmt, progress=progress)
+
+    def archive_days(self, days=None):
+        return days if days is not None else self.settings.get('archive_after_days', ARCHIVE_AFTER_DAYS)
+
+    def archivable(self, days=None, now=None):
+        # Copies, so a caller can check later whether a ticket changed
+        # while its archive segment was being written
+        cutoff = archive_cutoff(self.archive_days(days), now)
+        return [dict(device) for device in self.store if is_archivable(device, cutoff)]
+
+    def finish_archive(self, moved):
+        # Drops the archived tickets from the working set, except any that
+        # were edited (or reopened) meanwhile; those stay where they are.
+        done = [d['id'] for d in moved if self.store.get(d['id']) == d]
+        if len(done) < len(moved):
+            kept = set(done)
+            self.archive.take([d['id'] for d in moved if d['id'] not in kept])
+        self.save(deleted=done)
+        return done
+
+    def archive_closed(self, days=None, now=None):
+        moved = self.archivable(days, now)
+        self.archive.add(moved)
+        return self.finish_archive(moved)
+
+    def restore(self, device_ids):
+        # Moves archived tickets back into the working set
+        devices = [d for d in self.archive.take(device_ids) if d['id'] not in self.store]
+        self.save(changed=devices)
+        return devices
+
+    def parse_import(self, path, fmt=None, progress=None):
+        return import_devices(path, fmt, progress=progress)
+
+    def add_imported(self, devices):
+        ids = self.store.allocate_ids(len(devices))
+        devices = [{"id": device_id, **device} for device_id, device in zip(ids, devices)]
+        self.save(changed=devices)
+        return devices
+
+    def import_file(self, path, fmt=None, progress=None):
+        devices, errors = self.parse_import(path, fmt, progress)
+        return self.add_imported(devices), errors
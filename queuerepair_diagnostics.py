@@ -0,0 +1,212 @@
+import cProfile
+import json
+import logging
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+CAPTURES = ("cprofile", "tracemalloc")
+log = logging.getLogger(__name__)
+# Profiles/allocation dumps of slow operations kept in the diagnostics folder
+MAX_CAPTURES = 20
+
+
+class Diagnostics:
+    # Opt-in timings for the operations that can make the app stall: load,
+    # save, snapshot writes, filter, sort, dashboard, export, list drawing
+    # and Tk event-loop lag. Off unless settings.json has "diagnostics":
+    # true; then every measured operation adds to per-operation counters,
+    # anything slower than diagnostics_slow_ms goes to a rotating JSON Lines
+    # log in QueueRepairData/diagnostics, and with diagnostics_capture set
+    # to "cprofile" or "tracemalloc" a profile or allocation dump of it is
+    # saved next to the log.
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_ms = 500
+        self.capture = None
+        self.log_dir = None
+        self.ops = {}
+        self.lock = threading.Lock()
+        self._logger = None
+        self._profiling = threading.Lock()
+
+    def configure(self, data_dir, settings):
+        # A mistake in a diagnostics setting must not keep the app from
+        # starting; it is reported and the default used instead
+        capture = settings.get('diagnostics_capture')
+        if capture not in (None,) + CAPTURES:
+            log.warning("Ignoring diagnostics_capture %r in settings.json (use one of %s)",
+                        capture, ", ".join(CAPTURES))
+            capture = None
+        slow_ms = settings.get('diagnostics_slow_ms', 500)
+        if type(slow_ms) not in (int, float):
+            log.warning("Ignoring diagnostics_slow_ms %r in settings.json (must be a number)", slow_ms)
+            slow_ms = 500
+        self.slow_ms = slow_ms
+        self.capture = capture
+        self.log_dir = Path(data_dir) / "diagnostics"
+        self.close_log()
+        self.set_enabled(bool(settings.get('diagnostics', False)))
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        if enabled and self.capture == "tracemalloc" and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def measure(self, name, **info):
+        if not self.enabled:
+            return nullcontext()
+        return self._measure(name, info)
+
+    @contextmanager
+    def _measure(self, name, info):
+        profiler = None
+        # One profile at a time: cProfile can't nest, and a search on the
+        # worker thread would otherwise clash with a save on the Tk thread
+        if self.capture == "cprofile" and self._profiling.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Some other profiler is already active
+                self._profiling.release()
+                profiler = None
+        elif self.capture == "tracemalloc" and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                self._profiling.release()
+            self.record(name, elapsed, profiler=profiler, **info)
+
+    def record(self, name, seconds, profiler=None, **info):
+        if not self.enabled:
+            return
+        with self.lock:
+            op = self.ops.get(name)
+            if op is None:
+                op = self.ops[name] = {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0,
+                                       "samples": deque(maxlen=500)}
+            op['count'] += 1
+            op['total'] += seconds
+            op['max'] = max(op['max'], seconds)
+            op['last'] = seconds
+            op['samples'].append(seconds)
+        if seconds * 1000 >= self.slow_ms:
+            self.log_slow(name, seconds, profiler, info)
+
+    def log_slow(self, name, seconds, profiler, info):
+        entry = {"time": datetime.now().isoformat(timespec="seconds"), "op": name,
+                 "ms": round(seconds * 1000, 1), "thread": threading.current_thread().name}
+        entry.update(info)
+        try:
+            stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            if profiler is not None:
+                path = self.log_dir / f"{name}-{stamp}.prof"
+                self.log_dir.mkdir(parents=True, exist_ok=True)
+                profiler.dump_stats(path)
+                entry['profile'] = path.name
+                self.prune_captures()
+            elif self.capture == "tracemalloc" and tracemalloc.is_tracing():
+                current, peak = tracemalloc.get_traced_memory()
+                entry['traced_kb'] = current // 1024
+                entry['peak_kb'] = peak // 1024
+                path = self.log_dir / f"{name}-{stamp}.tracemalloc.txt"
+                self.log_dir.mkdir(parents=True, exist_ok=True)
+                top = tracemalloc.take_snapshot().statistics("lineno")[:25]
+                path.write_text("\n".join(str(stat) for stat in top) + "\n", encoding='utf-8')
+                entry['allocations'] = path.name
+                self.prune_captures()
+            self.write(entry)
+        except OSError:
+            # Diagnostics must never be the thing that breaks the app
+            pass
+
+    def prune_captures(self):
+        captures = sorted((p for p in self.log_dir.iterdir() if p.suffix in (".prof", ".txt")),
+                          key=lambda p: p.stat().st_mtime)
+        for path in captures[:-MAX_CAPTURES]:
+            path.unlink(missing_ok=True)
+
+    def write(self, entry):
+        if self._logger is None:
+            self.log_dir.mkdir(parents=True, exist_ok=True)
+            handler = RotatingFileHandler(self.log_dir / "diagnostics.log", maxBytes=1 << 20,
+                                          backupCount=5, encoding='utf-8')
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger = logging.getLogger(f"queuerepair.diagnostics.{id(self)}")
+            self._logger.propagate = False
+            self._logger.setLevel(logging.INFO)
+            self._logger.addHandler(handler)
+        self._logger.info(json.dumps(entry, default=str))
+
+    def summary(self):
+        # {operation: counts and timings in ms}, for the diagnostics window
+        # and the summary line written on close
+        with self.lock:
+            ops = {name: dict(op, samples=sorted(op['samples'])) for name, op in self.ops.items()}
+        result = {}
+        for name, op in sorted(ops.items()):
+            samples = op['samples']
+            result[name] = {
+                "count": op['count'],
+                "total_ms": round(op['total'] * 1000, 1),
+                "mean_ms": round(op['total'] / op['count'] * 1000, 2),
+                "p95_ms": round(samples[min(int(0.95 * len(samples)), len(samples) - 1)] * 1000, 2),
+                "max_ms": round(op['max'] * 1000, 2),
+                "last_ms": round(op['last'] * 1000, 2),
+            }
+        return result
+
+    def reset(self):
+        with self.lock:
+            self.ops.clear()
+
+    def flush(self):
+        # Leaves the session's totals in the log
+        if self.enabled and self.ops:
+            try:
+                self.write({"time": datetime.now().isoformat(timespec="seconds"), "op": "summary",
+                            "ops": self.summary()})
+            except OSError:
+                pass
+
+    def close_log(self):
+        if self._logger is not None:
+            for handler in list(self._logger.handlers):
+                self._logger.removeHandler(handler)
+                handler.close()
+            self._logger = None
+
+
+class LoopMonitor:
+    # Measures how late Tk runs a timer that should fire every interval_ms;
+    # anything beyond a few ms means the event loop was busy (a stall the
+    # technician would have felt). Recorded as "event_loop".
+
+    def __init__(self, root, diagnostics, interval_ms=100):
+        self.root = root
+        self.diagnostics = diagnostics
+        self.interval_ms = interval_ms
+        self._due = time.perf_counter() + interval_ms / 1000
+        self.root.after(self.interval_ms, self._tick)
+
+    def _tick(self):
+        now = time.perf_counter()
+        if self.diagnostics.enabled:
+            self.diagnostics.record("event_loop", max(now - self._due, 0.0))
+        self._due = now + self.interval_ms / 1000
+        self.root.after(self.interval_ms, self._tick)
+
+
+diagnostics = Diagnostics()
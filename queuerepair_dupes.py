@@ -0,0 +1,264 @@
+import re
+import threading
+from functools import lru_cache
+
+from queuerepair_search import tokenize
+
+OPEN_STATUSES = ("Pending",)
+
+# "S/N: ABC", "Serial No. ABC", "SN# ABC" -> "ABC". A bare "SN" prefix is
+# left alone, plenty of real serials start with it.
+LABEL_RE = re.compile(r"^\s*(?:s\s*/\s*n|serial(?:\s*(?:no|nr|num|number))?\.?|sn(?=\s*[:#]))(?![a-z0-9])"
+                      r"\s*[:#.\-]?\s*", re.IGNORECASE)
+NOT_ALNUM_RE = re.compile(r"[\W_]+")
+# Characters that get misread or mistyped for each other on labels
+CONFUSABLE = str.maketrans({"o": "0", "i": "1", "l": "1", "s": "5"})
+# What a serial key is made of once folded (no o, i, l or s left)
+KEY_ALPHABET = "abcdefghjkmnpqrtuvwxyz0123456789"
+
+
+def serial_key(serial):
+    text = LABEL_RE.sub("", str(serial or ""))
+    return NOT_ALNUM_RE.sub("", text.casefold()).translate(CONFUSABLE)
+
+
+@lru_cache(maxsize=4096)
+def device_key(device):
+    return " ".join(tokenize(device or ""))
+
+
+@lru_cache(maxsize=4096)
+def person_key(submitted, contact):
+    contact = " ".join(tokenize(contact or ""))
+    if contact:
+        return contact
+    submitted = " ".join(tokenize(submitted or ""))
+    return "" if submitted == "unknown" else submitted
+
+
+def fuzzy(key):
+    # Keys this short have to match exactly; longer ones may be one typo
+    # (a missing, extra or swapped character) apart. A different character
+    # in the same place is not a typo: serials handed out in sequence differ
+    # in just that way. Characters misread for each other are already
+    # folded together in the key.
+    return len(key) >= 5
+
+
+def one_edit_away(key, alphabet=KEY_ALPHABET):
+    alphabet = set(alphabet) | set(key)
+    splits = [(key[:i], key[i:]) for i in range(len(key) + 1)]
+    variants = {a + b[1:] for a, b in splits if b}
+    variants.update(a + b[1] + b[0] + b[2:] for a, b in splits if len(b) > 1)
+    variants.update(a + c + b for a, b in splits for c in alphabet)
+    variants.discard(key)
+    return variants
+
+
+def deletions(key):
+    # key and every string one deletion shorter. Two keys within one edit
+    # of each other (swaps included) always have one of these in common.
+    return {key} | {key[:i] + key[i + 1:] for i in range(len(key))}
+
+
+def typo_apart(a, b):
+    # One character missing or extra, or two neighbours swapped
+    if len(a) == len(b):
+        diff = [i for i in range(len(a)) if a[i] != b[i]]
+        return (len(diff) == 2 and diff[1] == diff[0] + 1
+                and a[diff[0]] == b[diff[1]] and a[diff[1]] == b[diff[0]])
+    if abs(len(a) - len(b)) != 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    return a[i:] == b[i + 1:]
+
+
+def near(a, b):
+    return a == b or (fuzzy(a) and fuzzy(b) and typo_apart(a, b))
+
+
+class DuplicateIndex:
+    # Finds tickets that are probably for the same physical device. Serials
+    # are reduced to a key (no case, spaces, dashes or "S/N:" label, O/0,
+    # I/L/1 and S/5 folded together) and tickets are hashed by key. A lookup
+    # probes the key and every string one typo away from it, a few hundred
+    # dict lookups however long the history is; the batch scan buckets keys
+    # by their one-deletion variants and only compares keys sharing a bucket.
+    # Tickets without a serial are matched on device name plus contact (or
+    # submitter). Kept up to date one ticket at a time like Metrics.
+
+    def __init__(self, devices=()):
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.by_serial = {}
+        self.by_person = {}
+        for device in devices:
+            self.add(device)
+
+    def add(self, device):
+        entry = (serial_key(device.get('serial')), device_key(device.get('device')),
+                 person_key(device.get('submitted'), device.get('contact')), device.get('status', ''))
+        with self.lock:
+            self.remove(device['id'])
+            self.entries[device['id']] = entry
+            skey, dkey, pkey, _ = entry
+            if skey:
+                self.by_serial.setdefault(skey, set()).add(device['id'])
+            if dkey and pkey:
+                self.by_person.setdefault(pkey, {}).setdefault(dkey, set()).add(device['id'])
+
+    def remove(self, device_id):
+        with self.lock:
+            entry = self.entries.pop(device_id, None)
+            if entry is None:
+                return
+            skey, dkey, pkey, _ = entry
+            if skey:
+                ids = self.by_serial[skey]
+                ids.discard(device_id)
+                if not ids:
+                    del self.by_serial[skey]
+            if dkey and pkey:
+                devices = self.by_person[pkey]
+                devices[dkey].discard(device_id)
+                if not devices[dkey]:
+                    del devices[dkey]
+                    if not devices:
+                        del self.by_person[pkey]
+
+    def update(self, device):
+        self.add(device)
+
+    def near_keys(self, key):
+        # Indexed serial keys equal to key or one edit away from it
+        found = [key] if key in self.by_serial else []
+        if fuzzy(key):
+            found.extend(other for other in one_edit_away(key) if other in self.by_serial and fuzzy(other))
+        return found
+
+    def similar(self, serial="", device="", submitted="", contact="", statuses=OPEN_STATUSES,
+                exclude=None, limit=5):
+        # [(id, score, reason)] best first; score is 1.0 for the same serial
+        skey = serial_key(serial)
+        dkey = device_key(device)
+        pkey = person_key(submitted, contact)
+        found = {}
+
+        def offer(device_id, score, reason):
+            entry = self.entries[device_id]
+            if device_id == exclude or (statuses is not None and entry[3] not in statuses):
+                return
+            if device_id not in found or found[device_id][0] < score:
+                found[device_id] = (score, reason)
+
+        with self.lock:
+            if skey:
+                for other in self.near_keys(skey):
+                    exact = other == skey
+                    score = 1.0 if exact else 1.0 - 1 / max(len(skey), len(other))
+                    for device_id in self.by_serial[other]:
+                        offer(device_id, score, "same serial" if exact else "similar serial")
+            if dkey and pkey:
+                for other, ids in self.by_person.get(pkey, {}).items():
+                    if not near(dkey, other):
+                        continue
+                    for device_id in ids:
+                        # Different serials are different devices, even from
+                        # the same person; a missing one could be either
+                        if not skey or not self.entries[device_id][0]:
+                            offer(device_id, 0.5 if other == dkey else 0.4, "same device and contact")
+        ranked = sorted(found.items(), key=lambda item: (-item[1][0], -item[0]))
+        return [(device_id, score, reason) for device_id, (score, reason) in ranked[:limit]]
+
+    def clusters(self, statuses=OPEN_STATUSES):
+        # Groups of ids (each sorted, biggest group first) that look like
+        # one device, without comparing every ticket to every other. Exact
+        # matches (same serial key, or a ticket without serial and the same
+        # device and person) are merged; a near match only ever joins the
+        # two tickets' own groups, so a run of serials one typo apart from
+        # their neighbours doesn't collapse into one group. A ticket can
+        # therefore show up in more than one group.
+        with self.lock:
+            scope = {device_id: entry for device_id, entry in self.entries.items()
+                     if statuses is None or entry[3] in statuses}
+            parent = {device_id: device_id for device_id in scope}
+
+            def find(i):
+                while parent[i] != i:
+                    parent[i] = parent[parent[i]]
+                    i = parent[i]
+                return i
+
+            def union(ids):
+                roots = {find(i) for i in ids}
+                first = min(roots, default=None)
+                for root in roots:
+                    parent[root] = first
+
+            def joinable(ids):
+                # Tickets without a serial go with the others, unless that
+                # would tie together tickets with different serials
+                bare = [i for i in ids if not scope[i][0]]
+                if not bare:
+                    return []
+                serials = {scope[i][0] for i in ids if scope[i][0]}
+                return ids if len(serials) <= 1 else bare
+
+            by_key = {}
+            for device_id, entry in scope.items():
+                if entry[0]:
+                    by_key.setdefault(entry[0], []).append(device_id)
+            for ids in by_key.values():
+                union(ids)
+
+            person_names = []
+            for devices in self.by_person.values():
+                names = {name: [i for i in ids if i in scope] for name, ids in devices.items()}
+                names = {name: ids for name, ids in names.items() if ids}
+                for ids in names.values():
+                    union(joinable(ids))
+                person_names.append(names)
+
+            pairs = []
+            buckets = {}
+            for key in by_key:
+                if fuzzy(key):
+                    for variant in deletions(key):
+                        buckets.setdefault(variant, []).append(key)
+            seen = set()
+            for keys in buckets.values():
+                for i, key in enumerate(keys):
+                    for other in keys[i + 1:]:
+                        if (key, other) not in seen and near(key, other):
+                            seen.add((key, other))
+                            pairs.append(by_key[key][:1] + by_key[other][:1])
+            for names in person_names:
+                listed = list(names)
+                for i, name in enumerate(listed):
+                    for other in listed[i + 1:]:
+                        if near(name, other):
+                            ids = joinable(names[name] + names[other])
+                            if ids:
+                                pairs.append(ids)
+
+            members = {}
+            for device_id in scope:
+                members.setdefault(find(device_id), []).append(device_id)
+            groups = {frozenset(ids) for ids in members.values() if len(ids) > 1}
+            for ids in pairs:
+                group = frozenset(i for root in {find(i) for i in ids} for i in members[root])
+                if len(group) > 1:
+                    groups.add(group)
+        # A group that is wholly part of a bigger one adds nothing
+        by_member = {}
+        for group in groups:
+            for device_id in group:
+                by_member.setdefault(device_id, []).append(group)
+        found = [sorted(group) for group in groups
+                 if not any(group < other for other in by_member[next(iter(group))])]
+        found.sort(key=lambda ids: (-len(ids), ids))
+        return found
@@ -0,0 +1,147 @@
+import csv
+import gzip
+import json
+from datetime import datetime
+from itertools import islice
+
+from queuerepair_diagnostics import diagnostics
+from queuerepair_search import DATE_FORMAT
+from queuerepair_store import FIELDS
+
+# CSV columns as they have always been exported, mapped to record fields
+CSV_COLUMNS = [
+    ("ID", "id"),
+    ("Device", "device"),
+    ("Serial", "serial"),
+    ("Issue", "issue"),
+    ("Submitted By", "submitted"),
+    ("Contact", "contact"),
+    ("Status", "status"),
+    ("Date Repaired", "date_repaired"),
+    ("Date Submitted", "date_submitted")
+]
+STATUSES = ("Pending", "Repaired", "Canceled")
+
+FORMATS = ("csv", "csv.gz", "jsonl")
+FILE_TYPES = [("CSV", "*.csv"), ("Compressed CSV", "*.csv.gz"), ("JSON Lines", "*.jsonl")]
+
+
+def detect_format(path):
+    name = str(path).lower()
+    if name.endswith(".csv.gz"):
+        return "csv.gz"
+    if name.endswith(".jsonl") or name.endswith(".ndjson"):
+        return "jsonl"
+    return "csv"
+
+
+def open_text(path, mode, fmt):
+    # Reading skips a byte order mark (Excel's "CSV UTF-8" starts with one)
+    encoding = 'utf-8-sig' if mode == "r" else 'utf-8'
+    if fmt == "csv.gz":
+        return gzip.open(path, mode + "t", newline='', encoding=encoding)
+    return open(path, mode, newline='', encoding=encoding)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def export_devices(devices, path, fmt=None, progress=None, chunk_size=1000):
+    # Writes tickets in chunks so it can run on a worker thread and report
+    # progress as it goes; the records are consumed lazily from any iterable.
+    fmt = fmt or detect_format(path)
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    count = 0
+    with diagnostics.measure("export", format=fmt), open_text(path, 'w', fmt) as f:
+        if fmt == "jsonl":
+            def write(chunk):
+                f.write("".join(json.dumps({k: d.get(k, '') for k in FIELDS}, ensure_ascii=False) + "\n"
+                                for d in chunk))
+        else:
+            writer = csv.writer(f)
+            writer.writerow([header for header, _ in CSV_COLUMNS])
+
+            def write(chunk):
+                writer.writerows([[d.get(field, '') for _, field in CSV_COLUMNS] for d in chunk])
+
+        for chunk in chunked(devices, chunk_size):
+            write(chunk)
+            count += len(chunk)
+            if progress is not None:
+                progress(count)
+    return count
+
+
+def validate_device(row):
+    # Turns one imported row into a ticket without an id (the store hands
+    # those out). Raises ValueError with a readable message on bad input.
+    device = {field: str(row.get(field) or '').strip() for field in FIELDS if field != "id"}
+    if not device['device'] or not device['issue']:
+        raise ValueError("device name and issue description are required")
+
+    device['submitted'] = device['submitted'] or "Unknown"
+    status = device['status'].capitalize() or "Pending"
+    if status == "Cancelled":
+        status = "Canceled"
+    if status not in STATUSES:
+        raise ValueError(f"unknown status '{device['status']}'")
+    device['status'] = status
+
+    for field in ("date_submitted", "date_repaired"):
+        if device[field]:
+            try:
+                datetime.strptime(device[field], DATE_FORMAT)
+            except ValueError:
+                raise ValueError(f"{field} must look like 2024-01-31 14:05") from None
+    if not device['date_submitted']:
+        device['date_submitted'] = datetime.now().strftime(DATE_FORMAT)
+    return device
+
+
+def read_rows(f, fmt):
+    if fmt == "jsonl":
+        for line_no, line in enumerate(f, 1):
+            if line.strip():
+                yield line_no, line
+        return
+
+    # Accept both our own export headers and raw field names
+    by_header = {header.lower(): field for header, field in CSV_COLUMNS}
+    by_header.update({field: field for field in FIELDS})
+    reader = csv.reader(f)
+    header = next(reader, None)
+    if header is None:
+        return
+    fields = [by_header.get(name.strip().lower()) for name in header]
+    for row in reader:
+        if any(cell.strip() for cell in row):
+            yield reader.line_num, {field: value for field, value in zip(fields, row) if field}
+
+
+def import_devices(path, fmt=None, progress=None, chunk_size=1000):
+    # Reads and validates a whole CSV / CSV.gz / JSON Lines file. Returns
+    # (devices, errors) so the caller can store every good row in one go.
+    fmt = fmt or detect_format(path)
+    devices = []
+    errors = []
+    with open_text(path, 'r', fmt) as f:
+        for line_no, row in read_rows(f, fmt):
+            try:
+                if isinstance(row, str):
+                    row = json.loads(row)
+                    if not isinstance(row, dict):
+                        raise ValueError("expected a JSON object")
+                devices.append(validate_device(row))
+            except ValueError as e:
+                errors.append((line_no, str(e)))
+            if progress is not None and line_no % chunk_size == 0:
+                progress(len(devices))
+    return devices, errors
@@ -0,0 +1,171 @@
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Hammers a running API server (queuerepair_server.py) with concurrent
+# keep-alive clients and reports throughput and latency as JSON, e.g.
+#   python queuerepair_loadtest.py --spawn --clients 50 --duration 10
+#   python queuerepair_loadtest.py --port 8765 --write-ratio 0.5 > run.json
+# --spawn starts a throwaway server on an empty temporary data folder.
+
+DEVICES = ["Dell Latitude 5420", "HP EliteBook 840", "Lenovo ThinkPad T14", "MacBook Air", "Surface Pro 7"]
+ISSUES = ["Screen flickers", "No power", "Keyboard broken", "Battery swelling", "Won't boot"]
+
+
+class Client:
+    def __init__(self, host, port, token=None):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        data = b"" if body is None else json.dumps(body).encode('utf-8')
+        head = [f"{method} {path} HTTP/1.1", f"Host: {self.host}", f"Content-Length: {len(data)}"]
+        if self.token:
+            head.append(f"Authorization: Bearer {self.token}")
+        self.writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + data)
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        payload = await self.reader.readexactly(length) if length else b""
+        return status, json.loads(payload) if payload else None
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def worker(client, args, deadline, results, ids):
+    rng = random.Random()
+    while time.perf_counter() < deadline:
+        roll = rng.random()
+        if roll < args.write_ratio / 2 or not ids:
+            kind, method, path = "add", "POST", "/tickets"
+            body = {"device": rng.choice(DEVICES), "issue": rng.choice(ISSUES),
+                    "serial": f"SN{rng.randrange(10**6):06d}", "submitted": "loadtest"}
+        elif roll < args.write_ratio:
+            kind, method, path, body = "status", "POST", f"/tickets/{rng.choice(ids)}/repaired", None
+        elif roll < args.write_ratio + (1 - args.write_ratio) / 2:
+            query = rng.choice(["", "status:pending", "dell", "serial:sn1", "keyboard"])
+            kind, method, path, body = "list", "GET", f"/tickets?q={query}&limit=50", None
+        else:
+            kind, method, path, body = "get", "GET", f"/tickets/{rng.choice(ids)}", None
+
+        start = time.perf_counter()
+        try:
+            status, payload = await client.request(method, path, body)
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            results.append((kind, time.perf_counter() - start, 0))
+            client.close()
+            client.writer = None
+            continue
+        results.append((kind, time.perf_counter() - start, status))
+        if kind == "add" and status == 201:
+            ids.append(payload['id'])
+
+
+def summarize(results, elapsed):
+    def latency(samples):
+        samples = sorted(samples)
+        if not samples:
+            return {}
+        pick = lambda q: samples[min(int(q * len(samples)), len(samples) - 1)] * 1000
+        return {"count": len(samples), "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+                "p50_ms": round(pick(0.50), 3), "p95_ms": round(pick(0.95), 3), "p99_ms": round(pick(0.99), 3)}
+
+    kinds = sorted({kind for kind, _, _ in results})
+    return {
+        "requests": len(results),
+        "errors": sum(1 for _, _, status in results if not 200 <= status < 400),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(results) / elapsed, 1),
+        "latency": latency([t for _, t, _ in results]),
+        "by_kind": {kind: latency([t for k, t, _ in results if k == kind]) for kind in kinds},
+    }
+
+
+async def run(args):
+    clients = [Client(args.host, args.port, args.token) for _ in range(args.clients)]
+    # Seed a few tickets so reads have something to hit
+    ids = []
+    for i in range(args.seed):
+        status, payload = await clients[0].request("POST", "/tickets", {"device": DEVICES[i % 5], "issue": ISSUES[i % 5]})
+        ids.append(payload['id'])
+
+    results = []
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*(worker(client, args, deadline, results, ids) for client in clients))
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.close()
+    return summarize(results, elapsed)
+
+
+async def wait_for_server(host, port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="queuerepair-loadtest", description="Load test for queuerepair_server.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--token")
+    parser.add_argument("--clients", type=int, default=20, help="concurrent connections (default: 20)")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds to run (default: 5)")
+    parser.add_argument("--write-ratio", type=float, default=0.3, help="share of requests that write (default: 0.3)")
+    parser.add_argument("--seed", type=int, default=100, help="tickets to create before measuring (default: 100)")
+    parser.add_argument("--spawn", action="store_true", help="start a server on a temporary data folder")
+    args = parser.parse_args(argv)
+
+    server = None
+    tmp = None
+    if args.spawn:
+        tmp = tempfile.TemporaryDirectory()
+        script = Path(__file__).with_name("queuerepair_server.py")
+        server = subprocess.Popen([sys.executable, str(script), "--data-dir", tmp.name, "--host", args.host,
+                                   "--port", str(args.port)], stdout=subprocess.DEVNULL)
+    try:
+        if server is not None:
+            asyncio.run(wait_for_server(args.host, args.port))
+        report = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            tmp.cleanup()
+    report.update(clients=args.clients, write_ratio=args.write_ratio)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import threading
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+class FileLock:
+    # Advisory lock on a file in the shared data folder, so QueueRepair
+    # instances on different machines take turns writing. Threads of one
+    # process queue up on a thread lock first; with reentrant=True the
+    # holder may take it again (the OS lock is only taken once).
+
+    def __init__(self, path, timeout=10.0, reentrant=True):
+        self.path = Path(path)
+        self.timeout = timeout
+        self._thread_lock = threading.RLock() if reentrant else threading.Lock()
+        self._depth = 0
+        self._file = None
+
+    def acquire(self, blocking=True):
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if self._depth == 0:
+            try:
+                locked = self._lock_file(blocking)
+            except BaseException:
+                self._thread_lock.release()
+                raise
+            if not locked:
+                self._thread_lock.release()
+                return False
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+                else:
+                    self._file.seek(0)
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            finally:
+                self._file.close()
+                self._file = None
+        self._thread_lock.release()
+
+    def _lock_file(self, blocking):
+        f = open(self.path, 'a+b')
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                self._file = f
+                return True
+            except OSError:
+                if not blocking or time.monotonic() >= deadline:
+                    f.close()
+                    if not blocking:
+                        return False
+                    raise TimeoutError(f"{self.path.parent} is locked by another QueueRepair instance "
+                                       f"(waited {self.timeout:.0f}s)") from None
+                time.sleep(0.05)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
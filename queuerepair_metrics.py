@@ -0,0 +1,128 @@
+import heapq
+from collections import Counter
+from datetime import datetime, timedelta
+
+from queuerepair_search import DATE_FORMAT
+
+
+def parse_date(value):
+    # Dates the app wrote itself ("2024-01-31 14:05") take the quick C
+    # parser; strptime handles anything else the format allows
+    try:
+        if len(value) == 16 and value[4] == value[7] == "-" and value[10] == " " and value[13] == ":" \
+                and value.isascii():
+            return datetime.fromisoformat(value)
+        return datetime.strptime(value, DATE_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+def week_start(day):
+    return day - timedelta(days=day.weekday())
+
+
+class Metrics:
+    # Dashboard aggregates kept up to date one ticket at a time. For every
+    # id we remember what it contributed, so an edit (even one made in place
+    # on the record) is undone and re-applied without rescanning anything.
+
+    def __init__(self, devices=(), recent_size=50):
+        self.recent_size = recent_size
+        self.contrib = {}
+        self.status = Counter()
+        self.per_day = Counter()
+        self.per_week = Counter()
+        self.submitters = Counter()
+        self.devices = Counter()
+        self.repair_minutes = 0.0
+        self.repaired_timed = 0
+        self.recent_heap = []
+        self.recent_ids = set()
+        self.recent_stale = False
+        for device in devices:
+            self.add(device)
+
+    def add(self, device):
+        date_submitted = device.get('date_submitted', '')
+        submitted = parse_date(date_submitted)
+        day = submitted.date() if submitted else None
+        minutes = None
+        if device['status'] == "Repaired" and submitted:
+            repaired = parse_date(device.get('date_repaired', ''))
+            if repaired:
+                minutes = (repaired - submitted).total_seconds() / 60
+
+        entry = (device['status'], device.get('submitted', ''), device.get('device', ''),
+                 day, minutes, date_submitted)
+        self.contrib[device['id']] = entry
+        self._apply(entry, 1)
+        self._push_recent(entry[5], device['id'])
+
+    def remove(self, device_id):
+        entry = self.contrib.pop(device_id, None)
+        if entry is None:
+            return
+        self._apply(entry, -1)
+        if device_id in self.recent_ids:
+            self.recent_ids.discard(device_id)
+            self.recent_heap = [item for item in self.recent_heap if item[1] != device_id]
+            heapq.heapify(self.recent_heap)
+            self.recent_stale = True
+
+    def update(self, device):
+        self.remove(device['id'])
+        self.add(device)
+
+    def _apply(self, entry, sign):
+        status, submitter, model, day, minutes, _ = entry
+        self.status[status] += sign
+        self.submitters[submitter] += sign
+        self.devices[model] += sign
+        if day is not None:
+            self.per_day[day.isoformat()] += sign
+            self.per_week[week_start(day).isoformat()] += sign
+        if minutes is not None:
+            self.repair_minutes += sign * minutes
+            self.repaired_timed += sign
+
+    def _push_recent(self, date_submitted, device_id):
+        item = (date_submitted, device_id)
+        if len(self.recent_heap) < self.recent_size:
+            # After a deletion the heap only holds the newest tickets down to
+            # its minimum; an older one could rank below tickets that were
+            # never kept, so it is left for the refill
+            if self.recent_stale and (not self.recent_heap or item < self.recent_heap[0]):
+                return
+            heapq.heappush(self.recent_heap, item)
+            self.recent_ids.add(device_id)
+            if len(self.recent_heap) == self.recent_size:
+                self.recent_stale = False
+        elif item > self.recent_heap[0]:
+            dropped = heapq.heapreplace(self.recent_heap, item)
+            self.recent_ids.discard(dropped[1])
+            self.recent_ids.add(device_id)
+
+    def recent(self, limit):
+        # Deleting one of the newest tickets leaves a hole in the heap; it is
+        # refilled from the remembered contributions only when it runs short.
+        if self.recent_stale and len(self.recent_heap) < min(limit, len(self.contrib)):
+            items = ((entry[5], device_id) for device_id, entry in self.contrib.items())
+            self.recent_heap = heapq.nlargest(self.recent_size, items)
+            heapq.heapify(self.recent_heap)
+            self.recent_ids = {device_id for _, device_id in self.recent_heap}
+            self.recent_stale = False
+        return [device_id for _, device_id in heapq.nlargest(limit, self.recent_heap)]
+
+    def status_counts(self):
+        return +self.status
+
+    def summary(self, now=None, top=3):
+        today = (now or datetime.now()).date()
+        return {
+            "mean_repair_hours": (self.repair_minutes / self.repaired_timed / 60
+                                  if self.repaired_timed else None),
+            "today": self.per_day[today.isoformat()],
+            "this_week": self.per_week[week_start(today).isoformat()],
+            "top_submitters": (+self.submitters).most_common(top),
+            "top_devices": (+self.devices).most_common(top),
+        }
@@ -0,0 +1,353 @@
+import queue
+import re
+import threading
+from datetime import datetime
+from functools import lru_cache
+
+# Fields searched by a plain query, and the ones that can be named with
+# "field:value" (e.g. "serial:ABC status:pending").
+SEARCH_FIELDS = ("device", "serial", "issue", "submitted", "contact")
+QUERY_FIELDS = SEARCH_FIELDS + ("status",)
+
+TOKEN_RE = re.compile(r"\w+")
+GRAM = 3
+
+DATE_FIELDS = ("date_submitted", "date_repaired")
+DATE_FORMAT = "%Y-%m-%d %H:%M"
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(str(text).lower())
+
+
+@lru_cache(maxsize=8192)
+def token_set(text):
+    # Most indexed values repeat across tickets (models, people, statuses),
+    # so the tokens of recently seen ones are remembered
+    return frozenset(tokenize(text))
+
+
+def prefixes(token):
+    return {token[:i] for i in range(1, min(len(token), GRAM - 1) + 1)}
+
+
+def grams(token):
+    return {token[i:i + GRAM] for i in range(len(token) - GRAM + 1)}
+
+
+def matches_terms(values, terms):
+    # Whether a ticket (anything with .get per field) has every term of a
+    # parsed query, by the index's rules: short terms match the start of a
+    # word, longer ones anywhere inside it
+    for fields, term in terms:
+        prefix_only = len(term) < GRAM
+        if not any((t.startswith(term) if prefix_only else term in t)
+                   for field in fields for t in token_set(values.get(field, ""))):
+            return False
+    return True
+
+
+def parse_query(query):
+    terms = []
+    for word in query.split():
+        field, sep, value = word.partition(":")
+        field = field.lower()
+        if sep and field in QUERY_FIELDS:
+            fields = (field,)
+        else:
+            fields, value = SEARCH_FIELDS, word
+        for token in tokenize(value):
+            terms.append((fields, token))
+    return terms
+
+
+class SearchIndex:
+    # Inverted index over the ticket text fields. Postings map a token to the
+    # ids that contain it (a bare id while there is only one, which is what
+    # most serials and phone numbers get). Every token is also filed under
+    # its first one and two characters for prefix lookups and under its
+    # trigrams so a term can match anywhere inside a token. Work per query
+    # grows with the number of hits, not the number of tickets. Per ticket
+    # only the indexed values are kept (the record's own string objects), so
+    # an edit made in place is undone by tokenizing what was indexed before.
+    # All public methods take the index lock so searches can run on a worker
+    # thread while the UI thread keeps the index up to date. With docs=False
+    # nothing per ticket is kept; such an index can be searched but not
+    # edited (the archive builds one per segment and never changes it).
+
+    def __init__(self, devices=(), docs=True):
+        self.lock = threading.RLock()
+        self.postings = {field: {} for field in QUERY_FIELDS}
+        self.docs = {} if docs else None
+        self.prefix_index = {}
+        self.gram_index = {}
+        for device in devices:
+            self.add(device)
+
+    def add(self, device):
+        with self.lock:
+            self._add(device)
+
+    def _add(self, device):
+        device_id = device['id']
+        values = tuple(device.get(field, "") for field in QUERY_FIELDS)
+        if self.docs is not None:
+            self.docs[device_id] = values
+        for field, value in zip(QUERY_FIELDS, values):
+            postings = self.postings[field]
+            for token in token_set(value):
+                ids = postings.get(token)
+                # Tokens shared by many tickets are the common case
+                if type(ids) is set:
+                    ids.add(device_id)
+                else:
+                    self._link(field, token, device_id)
+
+    def remove(self, device_id):
+        with self.lock:
+            values = self.docs.pop(device_id, None)
+            if values is None:
+                return
+            for field, value in zip(QUERY_FIELDS, values):
+                for token in token_set(value):
+                    self._unlink(field, token, device_id)
+
+    def update(self, device):
+        with self.lock:
+            old = self.docs.get(device['id'])
+            if old is None:
+                self._add(device)
+                return
+            values = tuple(device.get(field, "") for field in QUERY_FIELDS)
+            for field, before, after in zip(QUERY_FIELDS, old, values):
+                if before == after:
+                    continue
+                before, after = token_set(before), token_set(after)
+                for token in before - after:
+                    self._unlink(field, token, device['id'])
+                for token in after - before:
+                    self._link(field, token, device['id'])
+            self.docs[device['id']] = values
+
+    def _link(self, field, token, device_id):
+        postings = self.postings[field]
+        ids = postings.get(token)
+        if ids is None:
+            if not self._in_use(token):
+                for prefix in prefixes(token):
+                    self.prefix_index.setdefault(prefix, set()).add(token)
+                for gram in grams(token):
+                    self.gram_index.setdefault(gram, set()).add(token)
+            postings[token] = device_id
+        elif type(ids) is set:
+            ids.add(device_id)
+        elif ids != device_id:
+            postings[token] = {ids, device_id}
+
+    def _unlink(self, field, token, device_id):
+        postings = self.postings[field]
+        ids = postings[token]
+        if type(ids) is set:
+            ids.discard(device_id)
+            if len(ids) == 1:
+                postings[token] = ids.pop()
+            return
+        if ids != device_id:
+            return
+        del postings[token]
+        if self._in_use(token):
+            return
+        for index, keys in ((self.prefix_index, prefixes(token)), (self.gram_index, grams(token))):
+            for key in keys:
+                tokens = index[key]
+                tokens.discard(token)
+                if not tokens:
+                    del index[key]
+
+    def _in_use(self, token):
+        # Whether any field still has the token (it is filed only once)
+        return any(token in postings for postings in self.postings.values())
+
+    def expand(self, term):
+        # Vocabulary tokens a query term matches: prefix matches for very
+        # short terms, substring matches through the trigram index otherwise.
+        if len(term) < GRAM:
+            return list(self.prefix_index.get(term, ()))
+
+        candidates = sorted((self.gram_index.get(g, set()) for g in grams(term)), key=len)
+        if not candidates[0]:
+            return []
+        tokens = set(candidates[0]).intersection(*candidates[1:])
+        return [t for t in tokens if term in t]
+
+    def lookup(self, fields, term):
+        hits = set()
+        for token in self.expand(term):
+            for field in fields:
+                ids = self.postings[field].get(token)
+                if type(ids) is set:
+                    hits.update(ids)
+                elif ids is not None:
+                    hits.add(ids)
+        return hits
+
+    def search(self, query, cancelled=None):
+        # Returns the matching ids, or None when the query has no terms and
+        # therefore matches everything. A cancelled search returns early with
+        # whatever it had; the caller is expected to throw that away.
+        terms = parse_query(query)
+        if not terms:
+            return None
+        results = []
+        with self.lock:
+            for fields, term in terms:
+                if cancelled is not None and cancelled():
+                    return set()
+                results.append(self.lookup(fields, term))
+        results.sort(key=len)
+        hits = results[0]
+        for ids in results[1:]:
+            if not hits:
+                break
+            hits = hits & ids
+        return hits
+
+    def matches(self, device_id, query):
+        with self.lock:
+            values = self.docs.get(device_id)
+            if values is None:
+                return False
+            return matches_terms(dict(zip(QUERY_FIELDS, values)), parse_query(query))
+
+
+def sort_key(column, value):
+    # Keys are (rank, value) so every key of a column compares cleanly:
+    # real values first, anything unparseable next, blanks last.
+    if value is None or value == "":
+        return (2, "")
+    if column == "id":
+        try:
+            return (0, int(value))
+        except (TypeError, ValueError):
+            return (1, str(value).casefold())
+    if column in DATE_FIELDS:
+        try:
+            return (0, datetime.strptime(value, DATE_FORMAT))
+        except (TypeError, ValueError):
+            return (1, str(value).casefold())
+    return (0, str(value).casefold())
+
+
+class SortEngine:
+    # Orders ticket ids by typed column keys. Keys are computed once per
+    # column and cached by id; the store drops a ticket's cached keys when
+    # it changes, so re-sorting after an edit only recomputes that ticket.
+
+    def __init__(self, records):
+        self.records = records
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def invalidate(self, device_id):
+        with self.lock:
+            for keys in self.cache.values():
+                keys.pop(device_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def keys_for(self, column, ids):
+        keys = self.cache.setdefault(column, {})
+        records = self.records
+        for device_id in ids:
+            if device_id not in keys:
+                device = records.get(device_id)
+                keys[device_id] = sort_key(column, device.get(column) if device else None)
+        return keys
+
+    def sort(self, ids, spec):
+        # spec is a list of (column, descending), most significant first.
+        # Python's sort is stable, so sorting by each column from least to
+        # most significant gives a proper multi-column order; ties fall back
+        # to the order the ids came in.
+        with self.lock:
+            for column, descending in reversed(spec):
+                keys = self.keys_for(column, ids)
+                ids.sort(key=keys.__getitem__, reverse=descending)
+        return ids
+
+
+class SearchScheduler:
+    # Debounces search-box keystrokes, runs the query on a worker thread and
+    # feeds the results back to the Tk loop in chunks. Every new query bumps
+    # the generation, which makes older workers give up and their queued
+    # results get dropped.
+
+    def __init__(self, root, search, on_results, on_error=None, delay=150, chunk_size=5000, poll_ms=15):
+        self.root = root
+        self.search = search
+        self.on_results = on_results
+        self.on_error = on_error
+        self.delay = delay
+        self.chunk_size = chunk_size
+        self.poll_ms = poll_ms
+        self.generation = 0
+        self.busy = False
+        self._pending = None
+        self._polling = False
+        self._results = queue.Queue()
+
+    def schedule(self, query):
+        if self._pending is not None:
+            self.root.after_cancel(self._pending)
+        self._pending = self.root.after(self.delay, self.submit, query)
+
+    def submit(self, query, keep_position=False):
+        if self._pending is not None:
+            self.root.after_cancel(self._pending)
+            self._pending = None
+        self.generation += 1
+        self.busy = True
+        worker = threading.Thread(target=self._worker, args=(self.generation, query, keep_position), daemon=True)
+        worker.start()
+        if not self._polling:
+            self._polling = True
+            self.root.after(self.poll_ms, self._poll)
+
+    def _worker(self, generation, query, keep_position):
+        cancelled = lambda: generation != self.generation
+        try:
+            ids = self.search(query, cancelled)
+        except Exception as e:
+            self._results.put((generation, None, e, keep_position))
+            return
+        if cancelled():
+            return
+        for start in range(0, max(len(ids), 1), self.chunk_size):
+            if cancelled():
+                return
+            self._results.put((generation, ids[start:start + self.chunk_size], start, keep_position))
+        self._results.put((generation, None, None, keep_position))
+
+    def _poll(self):
+        # Hand over at most a few chunks per tick so the UI stays responsive
+        for _ in range(4):
+            try:
+                generation, ids, start, keep_position = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self.generation:
+                continue
+            if ids is None:
+                self.busy = False
+                if start is not None and self.on_error is not None:
+                    self.on_error(start)
+                self.on_results([], False, True, keep_position)
+            else:
+                self.on_results(ids, start == 0, False, keep_position)
+
+        if self.busy or not self._results.empty():
+            self.root.after(self.poll_ms, self._poll)
+        else:
+            self._polling = False
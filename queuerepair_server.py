@@ -0,0 +1,396 @@
+import argparse
+import asyncio
+import json
+import re
+import sys
+import time
+import zlib
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+from queuerepair_core import EDITABLE_FIELDS, RepairQueue, parse_sort
+from queuerepair_store import ConflictError
+from queuerepair_ticket import plain
+
+# Local HTTP/JSON API for kiosks and monitoring scripts, e.g.
+#   python queuerepair_server.py --port 8765
+#   curl -d '{"device": "Dell", "issue": "No power"}' localhost:8765/tickets
+#   curl "localhost:8765/tickets?q=status:pending&sort=date_submitted:desc&limit=20"
+#
+#   GET    /tickets                 q, sort, limit, offset, archive=1; sends an ETag
+#   POST   /tickets                 {"device", "issue", "serial", "submitted", "contact"}
+#   GET    /tickets/similar         serial, device, submitted, contact, limit: open
+#                                   tickets that look like the same device
+#   GET    /tickets/<id>
+#   PATCH  /tickets/<id>            any of the fields above and/or "status"
+#   POST   /tickets/<id>/repaired   same as Mark Repaired
+#   POST   /tickets/<id>/cancel     same as Cancel Repair
+#   DELETE /tickets/<id>
+#   GET    /duplicates              all=1 to include closed tickets
+#   GET    /stats
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+MAX_BODY = 1 << 20
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or status.phrase)
+        self.status = status
+
+
+def text_value(field, value):
+    # Ticket fields are text; null is taken as empty
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"Field '{field}' must be a string")
+    return value
+
+
+class WriteBatcher:
+    # Every write request is queued here. The writer waits a moment for
+    # more to arrive, applies the whole batch to the records and saves it
+    # with one store call (one journal append and fsync for the JSON store)
+    # before answering each request. A batch ends early when a ticket comes
+    # up twice, so every request sees the one before it saved.
+
+    def __init__(self, queue, on_saved, delay=0.002, max_batch=500):
+        self.queue = queue
+        self.on_saved = on_saved
+        self.delay = delay
+        self.max_batch = max_batch
+        self.pending = asyncio.Queue()
+        self.carry = None
+        self.batches = 0
+        self.writes = 0
+
+    async def submit(self, *op):
+        future = asyncio.get_running_loop().create_future()
+        await self.pending.put((op, future))
+        return await future
+
+    async def run(self):
+        while True:
+            batch = [self.carry or await self.pending.get()]
+            self.carry = None
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            touched = {batch[0][0][1]}
+            while len(batch) < self.max_batch and not self.pending.empty():
+                item = self.pending.get_nowait()
+                target = item[0][1]
+                if target is not None and target in touched:
+                    self.carry = item
+                    break
+                touched.add(target)
+                batch.append(item)
+            try:
+                self.apply(batch)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def apply(self, batch):
+        results = []
+        changed = []
+        deleted = []
+        adds = []
+        # Ids are reserved before anything is edited: reserving catches up
+        # with other instances, and doing that between our in-place edits
+        # and the save would hide their changes from the conflict check
+        count = sum(1 for (kind, _, _), _ in batch if kind == "add")
+        new_ids = iter(self.queue.store.allocate_ids(count) if count else ())
+        for op, future in batch:
+            kind, device_id, payload = op
+            try:
+                if kind == "add":
+                    ticket = self.queue.new_ticket(device_id=next(new_ids), **payload)
+                    adds.append(ticket)
+                    results.append((future, ticket, HTTPStatus.CREATED))
+                    continue
+                if self.queue.get(device_id) is None:
+                    raise HTTPError(HTTPStatus.NOT_FOUND, f"No ticket with ID {device_id}")
+                if kind == "delete":
+                    deleted.append(device_id)
+                    results.append((future, {"deleted": device_id}, HTTPStatus.OK))
+                    continue
+                status = payload.get('status')
+                if status is not None:
+                    self.queue.check_status(status)
+                fields = {k: v for k, v in payload.items() if k != "status"}
+                device = self.queue.apply_edit(device_id, **fields) if fields else self.queue.get(device_id)
+                if (status is not None and self.queue.apply_status(device, status)) or fields:
+                    changed.append(device)
+                results.append((future, device, HTTPStatus.OK))
+            except (HTTPError, ValueError, TypeError) as e:
+                if not future.done():
+                    future.set_exception(e)
+
+        conflicts = set()
+        if changed or adds or deleted:
+            try:
+                self.queue.save(changed + adds, deleted)
+            except ConflictError as e:
+                conflicts = set(e.ids)
+            self.batches += 1
+            self.writes += len(results)
+            self.on_saved()
+
+        for future, body, status in results:
+            if future.done():
+                continue
+            if body.get('id') in conflicts:
+                future.set_exception(HTTPError(HTTPStatus.CONFLICT, str(ConflictError([body['id']]))))
+            else:
+                future.set_result((status, body))
+
+
+class APIServer:
+    def __init__(self, queue, token=None, poll_interval=2.0):
+        self.queue = queue
+        self.token = token
+        self.poll_interval = poll_interval
+        # ETags carry when this server started as well as the write count,
+        # so none handed out before a restart can match again afterwards
+        self.started = f"{time.time_ns():x}"
+        self.version = 0
+        self.results = {}
+        self.writer = WriteBatcher(queue, self.changed)
+        self.routes = [
+            ("GET", re.compile(r"/tickets"), self.list_tickets),
+            ("POST", re.compile(r"/tickets"), self.add_ticket),
+            ("GET", re.compile(r"/tickets/similar"), self.similar_tickets),
+            ("GET", re.compile(r"/tickets/(\d+)"), self.get_ticket),
+            ("PATCH", re.compile(r"/tickets/(\d+)"), self.update_ticket),
+            ("POST", re.compile(r"/tickets/(\d+)/repaired"), self.mark_repaired),
+            ("POST", re.compile(r"/tickets/(\d+)/cancel"), self.cancel_repair),
+            ("DELETE", re.compile(r"/tickets/(\d+)"), self.delete_ticket),
+            ("GET", re.compile(r"/duplicates"), self.duplicates),
+            ("GET", re.compile(r"/stats"), self.stats),
+        ]
+
+    def changed(self):
+        # Any write (ours or another instance's) invalidates cached result
+        # lists and every ETag handed out so far
+        self.version += 1
+        self.results.clear()
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                if self.queue.poll() != set():
+                    self.changed()
+            except Exception as e:
+                # Keep polling; a half-written file or a busy database is
+                # usually fine by the next round
+                print(f"Checking for changes from other instances failed: {e!r}", file=sys.stderr, flush=True)
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        tasks = [asyncio.create_task(self.writer.run()), asyncio.create_task(self.poll())]
+        address = server.sockets[0].getsockname()
+        print(f"QueueRepair API listening on http://{address[0]}:{address[1]}", flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                try:
+                    status, payload, extra = await self.dispatch(method, target, headers, body)
+                except HTTPError as e:
+                    status, payload, extra = e.status, {"error": str(e)}, {}
+                except ValueError as e:
+                    status, payload, extra = HTTPStatus.BAD_REQUEST, {"error": str(e)}, {}
+                except Exception as e:
+                    status, payload, extra = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)}, {}
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self.respond(writer, status, payload, extra, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except HTTPError as e:
+            await self.respond(writer, e.status, {"error": str(e)}, {}, False)
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        try:
+            method, target, _ = line.decode('latin-1').split()
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST) from None
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Bad Content-Length") from None
+        if length > MAX_BODY:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), target, headers, body
+
+    async def respond(self, writer, status, payload, extra, keep_alive):
+        data = b"" if payload is None else json.dumps(payload, ensure_ascii=False, default=plain).encode('utf-8')
+        lines = [f"HTTP/1.1 {status.value} {status.phrase}",
+                 "Content-Type: application/json; charset=utf-8",
+                 f"Content-Length: {len(data)}",
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines.extend(f"{name}: {value}" for name, value in extra.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + data)
+        await writer.drain()
+
+    async def dispatch(self, method, target, headers, body):
+        if self.token and headers.get("authorization") != f"Bearer {self.token}":
+            raise HTTPError(HTTPStatus.UNAUTHORIZED)
+        url = urlsplit(target)
+        allowed = False
+        for route_method, pattern, handler in self.routes:
+            match = pattern.fullmatch(url.path.rstrip("/") or "/")
+            if not match:
+                continue
+            if route_method != method:
+                allowed = True
+                continue
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            args = [int(arg) for arg in match.groups()]
+            return await handler(*args, params=params, headers=headers, body=self.parse_body(body))
+        raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED if allowed else HTTPStatus.NOT_FOUND)
+
+    def parse_body(self, body):
+        if not body:
+            return {}
+        try:
+            data = json.loads(body)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Body must be a JSON object") from None
+        if not isinstance(data, dict):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Body must be a JSON object")
+        return data
+
+    def etag(self, params):
+        key = json.dumps(sorted(params.items())).encode('utf-8')
+        return f'"{self.started}-{self.version}-{zlib.crc32(key):08x}"'
+
+    async def list_tickets(self, params, headers, body):
+        etag = self.etag(params)
+        if headers.get("if-none-match") == etag:
+            return HTTPStatus.NOT_MODIFIED, None, {"ETag": etag}
+
+        query = params.get("q", "")
+        include_archive = params.get("archive", "") in ("1", "true", "yes")
+        sort = parse_sort(params["sort"].split(",")) if params.get("sort") else []
+        try:
+            limit = min(int(params.get("limit", DEFAULT_LIMIT)), MAX_LIMIT)
+            offset = max(int(params.get("offset", 0)), 0)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "limit and offset must be numbers") from None
+
+        # Result ids are cached per query until the next write, so paging
+        # through a big result doesn't search again for every page
+        key = (query, tuple(sort), include_archive)
+        version = self.version
+        ids = self.results.get(key)
+        if ids is None:
+            loop = asyncio.get_running_loop()
+            ids = await loop.run_in_executor(None, self.queue.search, query, sort, include_archive)
+            if version == self.version:
+                self.results[key] = ids
+        items = list(self.queue.tickets(ids[offset:offset + limit]))
+        following = offset + limit if offset + limit < len(ids) else None
+        return HTTPStatus.OK, {"total": len(ids), "offset": offset, "limit": limit,
+                               "next": following, "items": items}, {"ETag": etag}
+
+    async def get_ticket(self, device_id, params, headers, body):
+        device = self.queue.get(device_id)
+        if device is None:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"No ticket with ID {device_id}")
+        return HTTPStatus.OK, device, {}
+
+    async def similar_tickets(self, params, headers, body):
+        # Index lookups only, quick enough to answer on the event loop
+        try:
+            limit = min(int(params.get("limit", 5)), MAX_LIMIT)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "limit must be a number") from None
+        matches = self.queue.similar(params.get("device", ""), params.get("serial", ""),
+                                     params.get("submitted", ""), params.get("contact", ""), limit=limit)
+        items = [dict(ticket, score=round(score, 3), reason=reason) for ticket, score, reason in matches]
+        return HTTPStatus.OK, {"items": items}, {}
+
+    async def add_ticket(self, params, headers, body):
+        fields = {k: text_value(k, body.get(k)) for k in EDITABLE_FIELDS}
+        status, ticket = await self.writer.submit("add", None, fields)
+        return status, ticket, {"Location": f"/tickets/{ticket['id']}"}
+
+    async def update_ticket(self, device_id, params, headers, body):
+        unknown = set(body) - set(EDITABLE_FIELDS) - {"status"}
+        if unknown:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Field '{sorted(unknown)[0]}' can't be edited")
+        payload = {k: text_value(k, v) for k, v in body.items()}
+        if "status" in payload:
+            payload['status'] = payload['status'].capitalize()
+        status, device = await self.writer.submit("edit", device_id, payload)
+        return status, device, {}
+
+    async def mark_repaired(self, device_id, params, headers, body):
+        status, device = await self.writer.submit("edit", device_id, {"status": "Repaired"})
+        return status, device, {}
+
+    async def cancel_repair(self, device_id, params, headers, body):
+        status, device = await self.writer.submit("edit", device_id, {"status": "Canceled"})
+        return status, device, {}
+
+    async def delete_ticket(self, device_id, params, headers, body):
+        status, result = await self.writer.submit("delete", device_id, None)
+        return status, result, {}
+
+    async def duplicates(self, params, headers, body):
+        include_closed = params.get("all", "") in ("1", "true", "yes")
+        loop = asyncio.get_running_loop()
+        groups = await loop.run_in_executor(None, self.queue.duplicates, include_closed)
+        return HTTPStatus.OK, {"total": len(groups), "groups": groups}, {}
+
+    async def stats(self, params, headers, body):
+        return HTTPStatus.OK, self.queue.stats(), {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="queuerepair-server", description="QueueRepair - local HTTP/JSON API")
+    parser.add_argument("--data-dir", default="QueueRepairData", help="data folder (default: QueueRepairData)")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--token", help="require 'Authorization: Bearer TOKEN' on every request")
+    args = parser.parse_args(argv)
+
+    with RepairQueue(args.data_dir) as queue:
+        try:
+            asyncio.run(APIServer(queue, token=args.token).serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1066 @@
+import codecs
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from queuerepair_diagnostics import diagnostics
+from queuerepair_dupes import OPEN_STATUSES, DuplicateIndex
+from queuerepair_lock import FileLock
+from queuerepair_metrics import Metrics
+from queuerepair_search import GRAM, SEARCH_FIELDS, SearchIndex, SortEngine, matches_terms, parse_query
+from queuerepair_ticket import FIELDS, Ticket, plain
+
+WHITESPACE = re.compile(r"\s*")
+# In-memory indexes a DeviceStore keeps over its records, by attribute name
+INDEXES = (("index", SearchIndex), ("metrics", Metrics), ("dupes", DuplicateIndex))
+
+
+def write_json_atomic(path, data, indent=None):
+    tmp_file = path.with_name(path.name + ".tmp")
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=indent, default=plain)
+        f.flush()
+        os.fsync(f.fileno())
+    replace_file(tmp_file, path)
+
+
+def replace_file(src, dst, timeout=60.0):
+    retry_while_open(os.replace, src, dst, timeout=timeout)
+
+
+def remove_file(path, timeout=60.0):
+    retry_while_open(os.remove, path, timeout=timeout)
+
+
+def retry_while_open(action, *paths, timeout=60.0):
+    # On Windows a file can't be replaced or removed while another process
+    # has it open, e.g. an instance streaming the snapshot in without
+    # holding the lock or reading the journal. Wait for it to let go;
+    # elsewhere the first attempt always works.
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    while True:
+        try:
+            action(*paths)
+            return
+        except PermissionError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+
+def iter_json_array(f, chunk_size=1 << 20):
+    # Yields the items of a top-level JSON array from a binary file one by
+    # one, so a big snapshot can be consumed while it is still being read.
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf, pos, eof = "", 0, False
+    state = "start"
+
+    while True:
+        pos = WHITESPACE.match(buf, pos).end()
+        need_more = pos == len(buf)
+        if not need_more:
+            ch = buf[pos]
+            if state == "start":
+                if ch != "[":
+                    raise json.JSONDecodeError("Expecting '['", buf, pos)
+                pos += 1
+                state = "first"
+            elif state != "item" and ch == "]":
+                return
+            elif state == "next":
+                if ch != ",":
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buf, pos)
+                pos += 1
+                state = "item"
+            else:
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    end = None
+                # A value running up to the end of the buffer may have been
+                # cut off by the chunk boundary
+                if end is None or (end == len(buf) and not eof):
+                    need_more = True
+                else:
+                    yield item
+                    pos = end
+                    state = "next"
+
+        if need_more:
+            if eof:
+                raise json.JSONDecodeError("Unexpected end of data", buf, pos)
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + utf8.decode(chunk, final=eof)
+            pos = 0
+
+
+class ConflictError(ValueError):
+    # Raised when a save touches tickets another instance changed since this
+    # one last saw them; those tickets keep the other instance's version.
+    def __init__(self, ids):
+        self.ids = list(ids)
+        listed = ", ".join(f"#{i}" for i in self.ids[:10]) + (" ..." if len(self.ids) > 10 else "")
+        super().__init__(f"Ticket {listed} was changed by another user in the meantime. "
+                         "Their version is shown now; your change to it was not saved.")
+
+
+class JournalStore:
+    # Tickets are persisted as a JSON snapshot (repair_data.json, same format
+    # as always) plus an append-only journal with one compact line per change.
+    # A mutation only costs a journal append; once enough entries pile up the
+    # snapshot is rewritten in a background thread and the journal rotated.
+    #
+    # Several instances may share the folder. Writes happen under
+    # repair_data.lock and each instance follows the journal from the byte
+    # offset it has read up to. A rotation bumps the journal generation
+    # (written on the journal's first line), and the rotated journal is only
+    # removed by the next compaction so slower instances can read its tail.
+
+    def __init__(self, data_dir, compact_every=1000, fsync=True):
+        self.data_dir = Path(data_dir)
+        self.snapshot_file = self.data_dir / "repair_data.json"
+        self.journal_file = self.data_dir / "repair_data.journal"
+        self.rotated_file = self.data_dir / "repair_data.journal.old"
+        self.meta_file = self.data_dir / "repair_meta.json"
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.pending = 0
+        self.compact_error = None
+        self.meta = {}
+        self.max_id = 0
+        self.load_progress = 0.0
+        self.generation = 0
+        self.offset = 0
+        self.lock = FileLock(self.data_dir / "repair_data.lock")
+        self.compact_lock = FileLock(self.data_dir / "repair_data.compact.lock", reentrant=False)
+        self._signature = None
+        self._compactor = None
+
+    def load(self):
+        return [device for batch in self.load_iter() for device in batch]
+
+    def load_iter(self, batch_size=2000):
+        # Streams the tickets in batches. The journal is read first (it is
+        # small) so its edits and deletes can be applied to snapshot records
+        # as they go past; tickets that only exist in the journal come last.
+        self.load_progress = 0.0
+        changes = {}
+        with self.lock:
+            self.meta = self.read_meta()
+            # The rotated journal is usually already part of the snapshot.
+            # Entries are whole records or deletes by id, so replaying
+            # something the snapshot already contains is harmless.
+            rotated = self._replay(self.rotated_file, changes)
+            folded = self._header(self.rotated_file) in (None, self.meta.get('snapshot'))
+            self.pending = self._replay(self.journal_file, changes) + (0 if folded else rotated)
+            self.generation = self._header(self.journal_file)
+            if self.generation is None:
+                self.generation = self.meta.get('generation', 0)
+            self._signature = self._signature_of(self.journal_file)
+            self.offset = self._signature[1] if self._signature else 0
+            # Opened under the lock so it is the snapshot that goes with the
+            # journal just read, not one a compaction swaps in meanwhile
+            try:
+                snapshot = open(self.snapshot_file, 'rb')
+            except FileNotFoundError:
+                snapshot = None
+
+        batch = []
+        if snapshot is not None:
+            with snapshot as f:
+                size = os.fstat(f.fileno()).st_size or 1
+                for device in iter_json_array(f):
+                    if device['id'] in changes:
+                        device = changes.pop(device['id'])
+                        if device is None:
+                            continue
+                    batch.append(device)
+                    if len(batch) >= batch_size:
+                        self.load_progress = min(f.tell() / size, 1.0)
+                        yield batch
+                        batch = []
+
+        batch.extend(device for device in changes.values() if device is not None)
+        self.load_progress = 1.0
+        if batch:
+            yield batch
+
+    def read_meta(self):
+        if not self.meta_file.exists():
+            return {}
+        with open(self.meta_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def update_meta(self, **values):
+        # Read-modify-write under the lock; the id counter never goes back
+        with self.lock:
+            meta = self.read_meta()
+            if 'next_id' in values:
+                values['next_id'] = max(values['next_id'], meta.get('next_id', 1))
+            meta.update(values)
+            write_json_atomic(self.meta_file, meta)
+            self.meta = meta
+
+    def reserve_ids(self, next_id, count):
+        with self.lock:
+            first = max(next_id, self.read_meta().get('next_id', 1), self.max_id + 1)
+            self.update_meta(next_id=first + count)
+        return first
+
+    def _replay(self, path, changes):
+        # Collects the last journalled state of each id; None means deleted
+        if not path.exists():
+            return 0
+        data = path.read_bytes()
+        if data and not data.endswith(b"\n"):
+            # Torn write from a crash; drop the partial tail so new entries
+            # don't get glued onto it.
+            data = data[:data.rfind(b"\n") + 1]
+            with open(path, 'r+b') as f:
+                f.truncate(len(data))
+        return self._parse(data, changes)
+
+    def _parse(self, data, changes):
+        count = 0
+        for line in data.decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if entry['op'] == "put":
+                device = entry['device']
+                changes[device['id']] = device
+                self.max_id = max(self.max_id, device['id'])
+            elif entry['op'] == "del":
+                changes[entry['id']] = None
+                self.max_id = max(self.max_id, entry['id'])
+            else:
+                continue
+            count += 1
+        return count
+
+    def _header(self, path):
+        # Generation of a journal file; journals from before 1.2 have none
+        try:
+            with open(path, 'rb') as f:
+                line = f.readline()
+        except FileNotFoundError:
+            return None
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return 0
+        return entry.get('generation', 0) if entry.get('op') == "begin" else 0
+
+    def _signature_of(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _read_from(self, path, offset, changes):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        # Only whole lines; another instance may be halfway through a write
+        end = data.rfind(b"\n") + 1
+        self._parse(data[:end], changes)
+        return offset + end
+
+    def read_new(self):
+        # Changes other instances journalled since we last looked, as
+        # {id: device or None}. Costs a stat when nothing happened. Returns
+        # None if this instance fell a whole compaction behind and the
+        # entries it missed are gone; the caller then reloads.
+        signature = self._signature_of(self.journal_file)
+        if signature is None or signature == self._signature:
+            return {}
+        changes = {}
+        generation = self._header(self.journal_file)
+        if generation == self.generation:
+            offset = self._read_from(self.journal_file, self.offset, changes)
+        elif generation == self.generation + 1 and self._header(self.rotated_file) == self.generation:
+            self._read_from(self.rotated_file, self.offset, changes)
+            offset = self._read_from(self.journal_file, 0, changes)
+        else:
+            return None
+        self.generation, self.offset, self._signature = generation, offset, signature
+        return changes
+
+    def append(self, *entries):
+        # The caller holds the lock and has caught up with read_new(), so
+        # the journal ends exactly where this instance stopped reading.
+        if not entries:
+            return
+        data = "".join(json.dumps(e, separators=(",", ":"), default=plain) + "\n" for e in entries).encode('utf-8')
+        with self.lock:
+            with open(self.journal_file, 'ab') as f:
+                if f.tell() == 0:
+                    f.write(self._begin_line())
+                f.write(data)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+                self.offset = f.tell()
+            self._signature = self._signature_of(self.journal_file)
+        self.pending += len(entries)
+
+    def _begin_line(self):
+        return json.dumps({"op": "begin", "generation": self.generation}).encode('utf-8') + b"\n"
+
+    def put(self, *devices):
+        self.append(*({"op": "put", "device": d} for d in devices))
+
+    def delete(self, *device_ids):
+        self.append(*({"op": "del", "id": i} for i in device_ids))
+
+    def maybe_compact(self, snapshot, meta=None):
+        if self.pending >= self.compact_every:
+            self.compact(snapshot, meta)
+
+    def compact(self, snapshot, meta=None, wait=False):
+        # snapshot() is called under the lock right before the rotation; it
+        # catches up with the journal and returns every record up to there.
+        # With wait=True the caller must not hold the lock itself.
+        if self._compactor is not None and self._compactor.is_alive():
+            if not wait:
+                return
+            self._compactor.join()
+        if not self.compact_lock.acquire(blocking=wait):
+            # Another instance is writing the snapshot right now
+            return
+
+        try:
+            with self.lock:
+                devices = snapshot()
+                generation = self.generation
+                if self.journal_file.exists():
+                    old = self._header(self.rotated_file)
+                    if old is not None and old <= self.read_meta().get('snapshot', -1):
+                        remove_file(self.rotated_file)
+                    if self.rotated_file.exists():
+                        # Earlier compaction never finished; keep its entries
+                        # until this snapshot has safely replaced the old one.
+                        with open(self.journal_file, 'rb') as src:
+                            src.readline()
+                            entries = src.read()
+                        with open(self.rotated_file, 'ab') as out:
+                            out.write(entries)
+                        remove_file(self.journal_file)
+                    else:
+                        replace_file(self.journal_file, self.rotated_file)
+
+                # The meta file goes first: once the journal is folded away
+                # it is the only record of ids handed out and then deleted.
+                self.generation += 1
+                self.update_meta(generation=self.generation, **(meta or {}))
+                with open(self.journal_file, 'wb') as f:
+                    f.write(self._begin_line())
+                    self.offset = f.tell()
+                self._signature = self._signature_of(self.journal_file)
+                self.pending = 0
+
+                # Only the list is copied here; records edited in place while
+                # the snapshot is being written are also in the fresh journal,
+                # so the next load ends up consistent either way.
+                devices = list(devices)
+        except OSError as e:
+            self.compact_lock.release()
+            self.compact_error = e
+            return
+        except BaseException:
+            self.compact_lock.release()
+            raise
+
+        self._compactor = threading.Thread(target=self._compact_worker, args=(devices, generation), daemon=True)
+        self._compactor.start()
+        if wait:
+            self._compactor.join()
+
+    def _compact_worker(self, snapshot, generation):
+        try:
+            self.write_snapshot(snapshot)
+            self.update_meta(snapshot=generation)
+        except Exception as e:
+            self.compact_error = e
+        finally:
+            self.compact_lock.release()
+
+    def write_snapshot(self, devices):
+        with diagnostics.measure("snapshot", tickets=len(devices)):
+            write_json_atomic(self.snapshot_file, devices, indent=2)
+
+    def close(self):
+        if self._compactor is not None:
+            self._compactor.join()
+
+
+class DeviceStore:
+    # The ticket table: Ticket records keyed by id (dicts keep insertion
+    # order, so iteration still follows the order tickets were added) on top
+    # of the journal. Lookups, inserts and deletes are constant time, and the
+    # next id is a persisted counter so deleted ids are never handed out again.
+    # With indexed=False (one-off commands that add or change a few tickets)
+    # the search, dashboard and duplicate indexes are only built if something
+    # asks for them, instead of on every load.
+
+    def __init__(self, data_dir, journal=None, indexed=True):
+        self.journal = journal or JournalStore(data_dir)
+        self.indexed = indexed
+        self.records = {}
+        self.indexes = {name: kind() for name, kind in INDEXES} if indexed else {}
+        self.index_lock = threading.Lock()
+        self.sorter = SortEngine(self.records)
+        self.next_id = 1
+        # Per-record revision, bumped whenever another instance's change is
+        # merged in; a save checks it to catch edits that crossed
+        self.revs = {}
+        self.changed = set()
+        self.epoch = 0
+
+    def load(self):
+        for _ in self.load_iter():
+            pass
+        return self.records
+
+    def load_iter(self, batch_size=2000):
+        self.records = {}
+        self.indexes = {name: kind() for name, kind in INDEXES} if self.indexed else {}
+        self.sorter = SortEngine(self.records)
+        self.revs = {}
+        self.changed = set()
+        self.epoch += 1
+        indexes = list(self.indexes.values())
+        try:
+            for batch in self.journal.load_iter(batch_size):
+                batch = [Ticket(device) for device in batch]
+                for device in batch:
+                    self.records[device['id']] = device
+                    for index in indexes:
+                        index.add(device)
+                # Kept current batch by batch: a load cut short by a damaged
+                # file must not hand out the ids of tickets it did load
+                self.next_id = max(self.next_id, max(d['id'] for d in batch) + 1)
+                yield batch
+        finally:
+            self.next_id = max(self.next_id, self.journal.meta.get('next_id', 1), self.journal.max_id + 1)
+
+    @property
+    def load_progress(self):
+        return self.journal.load_progress
+
+    @property
+    def index(self):
+        return self._built("index")
+
+    @property
+    def metrics(self):
+        return self._built("metrics")
+
+    @property
+    def dupes(self):
+        return self._built("dupes")
+
+    def _built(self, name):
+        index = self.indexes.get(name)
+        if index is None:
+            with self.index_lock:
+                index = self.indexes.get(name)
+                if index is None:
+                    index = dict(INDEXES)[name](list(self.records.values()))
+                    self.indexes[name] = index
+        return index
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def __contains__(self, device_id):
+        return device_id in self.records
+
+    def get(self, device_id):
+        return self.records.get(device_id)
+
+    def ids(self):
+        return list(self.records)
+
+    def iter_records(self, ids):
+        for device_id in ids:
+            device = self.records.get(device_id)
+            if device is not None:
+                yield device
+
+    def allocate_id(self):
+        return self.allocate_ids(1)[0]
+
+    def allocate_ids(self, count):
+        # Reserved in repair_meta.json under the lock, so instances adding
+        # tickets at the same time never hand out the same id
+        with self.journal.lock:
+            self._sync()
+            first = self.journal.reserve_ids(self.next_id, count)
+        self.next_id = first + count
+        return range(first, first + count)
+
+    def _sync(self):
+        changes = self.journal.read_new()
+        if changes is None:
+            self.load()
+            return
+        for device_id, device in changes.items():
+            old = self.records.get(device_id)
+            if device is None:
+                if old is None:
+                    continue
+                del self.records[device_id]
+                for index in list(self.indexes.values()):
+                    index.remove(device_id)
+            elif device == old:
+                continue
+            else:
+                device = self.records[device_id] = Ticket(device)
+                for index in list(self.indexes.values()):
+                    index.update(device)
+            self.sorter.invalidate(device_id)
+            self.revs[device_id] = self.revs.get(device_id, 0) + 1
+            self.changed.add(device_id)
+        self.next_id = max(self.next_id, self.journal.max_id + 1)
+
+    def poll(self):
+        # Merges what other instances saved since the last call. Returns the
+        # ids that changed (deleted ones included), or None after a reload.
+        epoch = self.epoch
+        self._sync()
+        if self.epoch != epoch:
+            return None
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def update(self, devices):
+        # Inserts new records and persists edits made to existing ones.
+        # Edits to tickets another instance changed in the meantime are
+        # dropped (theirs wins) and reported with ConflictError.
+        devices = list(devices)
+        seen = {d['id']: (self.epoch, self.revs.get(d['id'], 0)) for d in devices if d['id'] in self.records}
+        with self.journal.lock:
+            self._sync()
+            conflicts = {i for i, rev in seen.items() if rev != (self.epoch, self.revs.get(i, 0))}
+            devices = [Ticket.from_dict(d) for d in devices if d['id'] not in conflicts]
+            for device in devices:
+                self.records[device['id']] = device
+                for index in list(self.indexes.values()):
+                    index.update(device)
+                self.sorter.invalidate(device['id'])
+            self.journal.put(*devices)
+            self._maybe_compact()
+        if conflicts:
+            raise ConflictError(sorted(conflicts))
+
+    def delete(self, device_ids):
+        removed = []
+        with self.journal.lock:
+            self._sync()
+            for device_id in device_ids:
+                device = self.records.pop(device_id, None)
+                if device is not None:
+                    for index in list(self.indexes.values()):
+                        index.remove(device_id)
+                    self.sorter.invalidate(device_id)
+                    removed.append(device)
+            self.journal.delete(*(d['id'] for d in removed))
+            self._maybe_compact()
+        return removed
+
+    def search(self, query, sort=None, cancelled=None):
+        # Safe to call from the search worker thread: the index has its own
+        # lock and records are only read through atomic dict operations.
+        with diagnostics.measure("filter", query=query):
+            terms = parse_query(query)
+            if not terms:
+                hits = None
+            elif "index" in self.indexes:
+                hits = self.index.search(query, cancelled)
+            else:
+                # Not indexed yet (indexed=False): one pass over the records
+                # is quicker than building the index for a single search
+                hits = {d['id'] for d in self.records.values() if matches_terms(d, terms)}
+            ids = self.ids() if hits is None else sorted(hits)
+        if sort:
+            with diagnostics.measure("sort", columns=[column for column, _ in sort], tickets=len(ids)):
+                self.sorter.sort(ids, sort)
+        return ids
+
+    def matches(self, device_id, query):
+        return self.index.matches(device_id, query)
+
+    def status_counts(self):
+        return self.metrics.status_counts()
+
+    def recent(self, limit):
+        return [self.records[i] for i in self.metrics.recent(limit)]
+
+    def stats(self):
+        return self.metrics.summary()
+
+    def similar(self, serial="", device="", submitted="", contact="", statuses=OPEN_STATUSES, exclude=None, limit=5):
+        return self.dupes.similar(serial, device, submitted, contact, statuses, exclude, limit)
+
+    def duplicate_clusters(self, statuses=OPEN_STATUSES):
+        return self.dupes.clusters(statuses)
+
+    def _snapshot(self):
+        self._sync()
+        return self.records.values()
+
+    def _maybe_compact(self):
+        self.journal.maybe_compact(self._snapshot, {"next_id": self.next_id})
+
+    @property
+    def compact_error(self):
+        return self.journal.compact_error
+
+    @compact_error.setter
+    def compact_error(self, error):
+        self.journal.compact_error = error
+
+    def compact(self, wait=False):
+        self.journal.compact(self._snapshot, {"next_id": self.next_id}, wait=wait)
+
+    def close(self):
+        self.journal.close()
+
+
+class SqliteStore:
+    # Optional backend keeping tickets in QueueRepairData/repair_data.db.
+    # Nothing is loaded up front: filtering goes through an FTS5 index,
+    # ordering and dashboard aggregates are done by SQLite using the column
+    # indexes. Same interface as DeviceStore, so the GUI doesn't care which
+    # one it talks to.
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tickets (
+            id INTEGER PRIMARY KEY,
+            device TEXT NOT NULL DEFAULT '',
+            serial TEXT NOT NULL DEFAULT '' COLLATE NOCASE,
+            issue TEXT NOT NULL DEFAULT '',
+            submitted TEXT NOT NULL DEFAULT '',
+            contact TEXT NOT NULL DEFAULT '',
+            status TEXT NOT NULL DEFAULT 'Pending' COLLATE NOCASE,
+            date_submitted TEXT NOT NULL DEFAULT '',
+            date_repaired TEXT NOT NULL DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS idx_tickets_status ON tickets(status);
+        CREATE INDEX IF NOT EXISTS idx_tickets_serial ON tickets(serial);
+        CREATE INDEX IF NOT EXISTS idx_tickets_date_submitted ON tickets(date_submitted);
+        CREATE INDEX IF NOT EXISTS idx_tickets_date_repaired ON tickets(date_repaired);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        CREATE VIRTUAL TABLE IF NOT EXISTS tickets_fts USING fts5(
+            device, serial, issue, submitted, contact,
+            content='tickets', content_rowid='id', prefix='1 2 3'
+        );
+        CREATE TRIGGER IF NOT EXISTS tickets_ai AFTER INSERT ON tickets BEGIN
+            INSERT INTO tickets_fts(rowid, device, serial, issue, submitted, contact)
+            VALUES (new.id, new.device, new.serial, new.issue, new.submitted, new.contact);
+        END;
+        CREATE TRIGGER IF NOT EXISTS tickets_ad AFTER DELETE ON tickets BEGIN
+            INSERT INTO tickets_fts(tickets_fts, rowid, device, serial, issue, submitted, contact)
+            VALUES ('delete', old.id, old.device, old.serial, old.issue, old.submitted, old.contact);
+        END;
+        CREATE TRIGGER IF NOT EXISTS tickets_au AFTER UPDATE ON tickets BEGIN
+            INSERT INTO tickets_fts(tickets_fts, rowid, device, serial, issue, submitted, contact)
+            VALUES ('delete', old.id, old.device, old.serial, old.issue, old.submitted, old.contact);
+            INSERT INTO tickets_fts(rowid, device, serial, issue, submitted, contact)
+            VALUES (new.id, new.device, new.serial, new.issue, new.submitted, new.contact);
+        END;
+        CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, id INTEGER NOT NULL);
+        CREATE TRIGGER IF NOT EXISTS changes_ai AFTER INSERT ON tickets BEGIN
+            INSERT INTO changes (id) VALUES (new.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS changes_ad AFTER DELETE ON tickets BEGIN
+            INSERT INTO changes (id) VALUES (old.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS changes_au AFTER UPDATE ON tickets BEGIN
+            INSERT INTO changes (id) VALUES (new.id);
+        END;
+    """
+    # Terms of three or more characters match anywhere inside a word, like
+    # the JSON store, through a second FTS5 table split into trigrams. The
+    # trigram tokenizer needs SQLite 3.34; older ones only match the start
+    # of words. The first open with a new enough SQLite fills the table in.
+    TRIGRAM_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS tickets_tri USING fts5(
+            device, serial, issue, submitted, contact,
+            content='tickets', content_rowid='id', tokenize='trigram'
+        );
+        INSERT INTO tickets_tri(tickets_tri) VALUES ('rebuild');
+        CREATE TRIGGER IF NOT EXISTS tickets_tri_ai AFTER INSERT ON tickets BEGIN
+            INSERT INTO tickets_tri(rowid, device, serial, issue, submitted, contact)
+            VALUES (new.id, new.device, new.serial, new.issue, new.submitted, new.contact);
+        END;
+        CREATE TRIGGER IF NOT EXISTS tickets_tri_ad AFTER DELETE ON tickets BEGIN
+            INSERT INTO tickets_tri(tickets_tri, rowid, device, serial, issue, submitted, contact)
+            VALUES ('delete', old.id, old.device, old.serial, old.issue, old.submitted, old.contact);
+        END;
+        CREATE TRIGGER IF NOT EXISTS tickets_tri_au AFTER UPDATE ON tickets BEGIN
+            INSERT INTO tickets_tri(tickets_tri, rowid, device, serial, issue, submitted, contact)
+            VALUES ('delete', old.id, old.device, old.serial, old.issue, old.submitted, old.contact);
+            INSERT INTO tickets_tri(rowid, device, serial, issue, submitted, contact)
+            VALUES (new.id, new.device, new.serial, new.issue, new.submitted, new.contact);
+        END;
+    """
+    # How many entries of the change log to keep for other instances
+    CHANGE_LOG_SIZE = 10000
+
+    def __init__(self, data_dir):
+        self.db_file = Path(data_dir) / "repair_data.db"
+        self.conn = None
+        self.next_id = 1
+        self.count = 0
+        self.compact_error = None
+        self.load_progress = 0.0
+        self.seq = 0
+        self.data_version = None
+        self.changed = set()
+        self.stale = False
+        self._local = threading.local()
+        self._dupes = None
+        self.trigrams = False
+
+    def connect(self):
+        # Plain rollback journal rather than WAL: WAL keeps its index in
+        # shared memory, which doesn't work across machines on a network
+        # share. Readers then hold writers off for a moment, hence the
+        # longer busy timeout. (Switching a database out of WAL only works
+        # while nothing else has it open; until then it stays as it was.)
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=DELETE")
+        return conn
+
+    def _reader(self):
+        # Search runs on worker threads, which need their own connection
+        if threading.current_thread() is threading.main_thread():
+            return self.conn
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self.connect()
+        return conn
+
+    def load(self):
+        self.conn = self.connect()
+        self._dupes = None
+        with self.conn:
+            self.conn.executescript(self.SCHEMA)
+        self.trigrams = self._create_trigrams()
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+        max_id = self.conn.execute("SELECT max(id) FROM tickets").fetchone()[0] or 0
+        self.next_id = max(row[0] if row else 1, max_id + 1)
+        self.count = self.conn.execute("SELECT count(*) FROM tickets").fetchone()[0]
+        self.seq = self.conn.execute("SELECT max(seq) FROM changes").fetchone()[0] or 0
+        with self.conn:
+            self.conn.execute("DELETE FROM changes WHERE seq <= ?", (self.seq - self.CHANGE_LOG_SIZE,))
+        self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self.load_progress = 1.0
+
+    def _create_trigrams(self):
+        if self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'tickets_tri'").fetchone():
+            return True
+        try:
+            self.conn.executescript("BEGIN IMMEDIATE;" + self.TRIGRAM_SCHEMA + "COMMIT;")
+        except sqlite3.OperationalError:
+            # No trigram tokenizer in this SQLite
+            if self.conn.in_transaction:
+                self.conn.rollback()
+            return False
+        return True
+
+    def load_iter(self, batch_size=2000):
+        # Nothing to stream: rows stay in the database until asked for
+        self.load()
+        return iter(())
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for row in self._reader().execute("SELECT * FROM tickets ORDER BY id"):
+            yield dict(row)
+
+    def __contains__(self, device_id):
+        return self.get(device_id) is not None
+
+    def get(self, device_id):
+        row = self._reader().execute("SELECT * FROM tickets WHERE id = ?", (device_id,)).fetchone()
+        return dict(row) if row else None
+
+    def ids(self):
+        return [row[0] for row in self._reader().execute("SELECT id FROM tickets ORDER BY id")]
+
+    def iter_records(self, ids, batch_size=500):
+        # Fetches rows a batch at a time but yields them in the order given
+        ids = list(ids)
+        for start in range(0, len(ids), batch_size):
+            chunk = ids[start:start + batch_size]
+            marks = ",".join("?" * len(chunk))
+            rows = {row['id']: dict(row) for row in
+                    self._reader().execute(f"SELECT * FROM tickets WHERE id IN ({marks})", chunk)}
+            for device_id in chunk:
+                if device_id in rows:
+                    yield rows[device_id]
+
+    def allocate_id(self):
+        return self.allocate_ids(1)[0]
+
+    def allocate_ids(self, count):
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+            max_id = self.conn.execute("SELECT max(id) FROM tickets").fetchone()[0] or 0
+            first = max(self.next_id, row[0] if row else 1, max_id + 1)
+            self.next_id = first + count
+            self._save_next_id()
+        return range(first, first + count)
+
+    def _save_next_id(self):
+        self.conn.execute("INSERT INTO meta (key, value) VALUES ('next_id', ?) "
+                          "ON CONFLICT(key) DO UPDATE SET value = max(value, excluded.value)", (self.next_id,))
+
+    def _pull(self):
+        # Ticket ids other connections changed since we last looked. Call
+        # inside a write transaction (or between them) so our own writes
+        # aren't mixed in.
+        oldest = self.conn.execute("SELECT min(seq) FROM changes").fetchone()[0]
+        rows = self.conn.execute("SELECT seq, id FROM changes WHERE seq > ? ORDER BY seq", (self.seq,)).fetchall()
+        if not rows:
+            return set()
+        if oldest > self.seq + 1:
+            # The log was trimmed past what we had seen
+            self.stale = True
+        self.seq = rows[-1][0]
+        self.count = self.conn.execute("SELECT count(*) FROM tickets").fetchone()[0]
+        self.changed.update(row[1] for row in rows)
+        ids = {row[1] for row in rows}
+        if self.stale:
+            self._dupes = None
+        elif self._dupes is not None:
+            for device_id in ids:
+                device = self.conn.execute("SELECT * FROM tickets WHERE id = ?", (device_id,)).fetchone()
+                if device is None:
+                    self._dupes.remove(device_id)
+                else:
+                    self._dupes.update(dict(device))
+        return ids
+
+    def poll(self):
+        # PRAGMA data_version only moves when another connection commits,
+        # so an idle poll is one cheap query.
+        version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self.data_version:
+            self.data_version = version
+            self._pull()
+        if self.stale:
+            self.stale = False
+            self.changed = set()
+            return None
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def update(self, devices):
+        # Same rules as DeviceStore.update: an edit to a ticket another
+        # instance changed since our last look is dropped with ConflictError
+        devices = list(devices)
+        ids = [d['id'] for d in devices]
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            foreign = self._pull()
+            existing = set()
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                marks = ",".join("?" * len(chunk))
+                existing.update(r[0] for r in self.conn.execute(f"SELECT id FROM tickets WHERE id IN ({marks})", chunk))
+            conflicts = foreign & set(ids)
+            if conflicts:
+                devices = [d for d in devices if d['id'] not in conflicts]
+            self.conn.executemany(
+                f"INSERT INTO tickets ({', '.join(FIELDS)}) VALUES ({', '.join('?' * len(FIELDS))}) "
+                f"ON CONFLICT(id) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in FIELDS[1:])}",
+                [tuple(d.get(c, "") for c in FIELDS) for d in devices])
+            self._save_next_id()
+            self.seq = self.conn.execute("SELECT max(seq) FROM changes").fetchone()[0] or 0
+        self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self.count += len({d['id'] for d in devices} - existing)
+        if self._dupes is not None:
+            for device in devices:
+                self._dupes.update(device)
+        if conflicts:
+            raise ConflictError(sorted(conflicts))
+
+    def delete(self, device_ids):
+        device_ids = list(device_ids)
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._pull()
+            removed = [d for d in map(self.get, device_ids) if d is not None]
+            self.conn.executemany("DELETE FROM tickets WHERE id = ?", [(d['id'],) for d in removed])
+            self._save_next_id()
+            self.seq = self.conn.execute("SELECT max(seq) FROM changes").fetchone()[0] or 0
+        self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self.count -= len(removed)
+        if self._dupes is not None:
+            for device in removed:
+                self._dupes.remove(device['id'])
+        return removed
+
+    def _where(self, query):
+        # Same rules as SearchIndex: short terms match the start of a word,
+        # longer ones anywhere inside it
+        fts_terms = []
+        tri_terms = []
+        clauses = []
+        params = []
+        for fields, term in parse_query(query):
+            inside = len(term) >= GRAM and self.trigrams
+            if fields == ("status",):
+                clauses.append("status LIKE ?")
+                params.append(("%" if inside else "") + term + "%")
+                continue
+            column = "" if fields == SEARCH_FIELDS else f"{fields[0]} : "
+            if inside:
+                tri_terms.append(f'{column}"{term}"')
+            else:
+                fts_terms.append(f'{column}"{term}"*')
+        for table, terms in (("tickets_fts", fts_terms), ("tickets_tri", tri_terms)):
+            if terms:
+                clauses.append(f"id IN (SELECT rowid FROM {table} WHERE {table} MATCH ?)")
+                params.append(" AND ".join(terms))
+        return clauses, params
+
+    def search(self, query, sort=None, cancelled=None):
+        clauses, params = self._where(query)
+        sql = "SELECT id FROM tickets"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        order = []
+        for column, descending in sort or ():
+            if column in FIELDS:
+                # Blanks go after everything else, as in sort_key
+                collate = " COLLATE NOCASE" if column in SEARCH_FIELDS else ""
+                direction = 'DESC' if descending else 'ASC'
+                order.append(f"({column} = '') {direction}, {column}{collate} {direction}")
+        sql += " ORDER BY " + ", ".join(order + ["id"])
+
+        # Filtering and ordering are one query here, so both count as filter
+        ids = []
+        with diagnostics.measure("filter", query=query, sort=[column for column, _ in sort or ()]):
+            cursor = self._reader().execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(5000)
+                if not rows or (cancelled is not None and cancelled()):
+                    break
+                ids.extend(row[0] for row in rows)
+        return ids
+
+    def matches(self, device_id, query):
+        clauses, params = self._where(query)
+        sql = "SELECT 1 FROM tickets WHERE " + " AND ".join(clauses + ["id = ?"])
+        return self._reader().execute(sql, params + [device_id]).fetchone() is not None
+
+    def status_counts(self):
+        rows = self._reader().execute("SELECT status, count(*) FROM tickets GROUP BY status")
+        return Counter({status: count for status, count in rows})
+
+    def recent(self, limit):
+        rows = self._reader().execute("SELECT * FROM tickets ORDER BY date_submitted DESC LIMIT ?", (limit,))
+        return [dict(row) for row in rows]
+
+    def stats(self, top=3):
+        conn = self._reader()
+        today = datetime.now().date()
+        monday = today - timedelta(days=today.weekday())
+        mean_hours = conn.execute(
+            "SELECT avg((julianday(date_repaired) - julianday(date_submitted)) * 24) FROM tickets "
+            "WHERE status = 'Repaired' AND date_repaired != '' AND date_submitted != ''").fetchone()[0]
+        count = "SELECT count(*) FROM tickets WHERE date_submitted >= ? AND date_submitted < ?"
+        top_of = "SELECT {0}, count(*) AS n FROM tickets GROUP BY {0} ORDER BY n DESC LIMIT ?"
+        return {
+            "mean_repair_hours": mean_hours,
+            "today": conn.execute(count, (today.isoformat(), (today + timedelta(days=1)).isoformat())).fetchone()[0],
+            "this_week": conn.execute(count, (monday.isoformat(), (monday + timedelta(days=7)).isoformat())).fetchone()[0],
+            "top_submitters": [tuple(row) for row in conn.execute(top_of.format("submitted"), (top,))],
+            "top_devices": [tuple(row) for row in conn.execute(top_of.format("device"), (top,))],
+        }
+
+    def duplicate_index(self):
+        # Serial lookups need edit distances, which SQLite can't index, so
+        # the few columns involved are kept in memory once first asked for
+        if self._dupes is None:
+            rows = self._reader().execute("SELECT id, device, serial, submitted, contact, status FROM tickets")
+            self._dupes = DuplicateIndex(dict(row) for row in rows)
+        return self._dupes
+
+    def similar(self, serial="", device="", submitted="", contact="", statuses=OPEN_STATUSES, exclude=None, limit=5):
+        return self.duplicate_index().similar(serial, device, submitted, contact, statuses, exclude, limit)
+
+    def duplicate_clusters(self, statuses=OPEN_STATUSES):
+        return self.duplicate_index().clusters(statuses)
+
+    def compact(self, wait=False):
+        pass
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def migrate_json_to_sqlite(data_dir):
+    # One-shot copy of the JSON snapshot and journal into repair_data.db.
+    # The JSON files are left alone so going back is just a settings change.
+    source = DeviceStore(data_dir, indexed=False)
+    source.load()
+    target = SqliteStore(data_dir)
+    target.load()
+    target.next_id = max(target.next_id, source.next_id)
+    target.update(source)
+    source.close()
+    return target
+
+
+def load_settings(data_dir):
+    settings_file = Path(data_dir) / "settings.json"
+    if not settings_file.exists():
+        return {}
+    with open(settings_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def open_store(data_dir, indexed=True):
+    # QueueRepairData/settings.json picks the backend:
+    #   {"storage": "json"}    repair_data.json + journal (default)
+    #   {"storage": "sqlite"}  repair_data.db, migrated from JSON on first use
+    # indexed only matters for the JSON store (see DeviceStore)
+    data_dir = Path(data_dir)
+    settings = load_settings(data_dir)
+    if settings.get('storage') != "sqlite":
+        return DeviceStore(data_dir, indexed=indexed)
+    has_json = any((data_dir / name).exists() for name in ("repair_data.json", "repair_data.journal"))
+    if has_json and not (data_dir / "repair_data.db").exists():
+        migrate_json_to_sqlite(data_dir).close()
+    return SqliteStore(data_dir)
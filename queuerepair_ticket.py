@@ -0,0 +1,182 @@
+import sys
+from datetime import date
+from functools import lru_cache
+
+FIELDS = ("id", "device", "serial", "issue", "submitted", "contact", "status", "date_submitted", "date_repaired")
+
+# Values that repeat across thousands of tickets share one string object
+INTERNED_FIELDS = ("device", "submitted", "contact", "status")
+DATE_FIELDS = ("date_submitted", "date_repaired")
+FIELD_SET = frozenset(FIELDS)
+
+EPOCH = date(1970, 1, 1).toordinal()
+
+
+def pack_date(value):
+    # "2024-01-31 14:05" -> minutes since 1970 as an int. Anything that
+    # wouldn't format back to exactly the same text is kept as it is (boxed
+    # in a tuple if it happens to be an int already).
+    if type(value) is int:
+        return (value,)
+    if type(value) is not str or len(value) != 16 or value[10] != " ":
+        return value
+    day = day_number(value[:10])
+    minute = minute_number(value[11:])
+    if day is None or minute is None:
+        return value
+    return day * 1440 + minute
+
+
+# Tickets share days and times of day, so both halves are parsed once each
+@lru_cache(maxsize=8192)
+def day_number(text):
+    # "2024-01-31" -> days since 1970, or None
+    if text[4] != "-" or text[7] != "-":
+        return None
+    digits = text[0:4] + text[5:7] + text[8:10]
+    if not (digits.isascii() and digits.isdigit()):
+        return None
+    try:
+        return date(int(text[0:4]), int(text[5:7]), int(text[8:10])).toordinal() - EPOCH
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=2048)
+def minute_number(text):
+    # "14:05" -> minutes since midnight, or None
+    if text[2] != ":":
+        return None
+    digits = text[0:2] + text[3:5]
+    if not (digits.isascii() and digits.isdigit()):
+        return None
+    hour, minute = int(text[0:2]), int(text[3:5])
+    if hour > 23 or minute > 59:
+        return None
+    return hour * 60 + minute
+
+
+def interned(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+# How each field is stored (None: as it is)
+STORED_AS = {field: None for field in FIELDS}
+STORED_AS.update({field: pack_date for field in DATE_FIELDS})
+STORED_AS.update({field: interned for field in INTERNED_FIELDS})
+
+
+def unpack_date(value):
+    if type(value) is not int:
+        return value[0] if type(value) is tuple else value
+    days, minutes = divmod(value, 1440)
+    return f"{day_text(days)} {minutes // 60:02d}:{minutes % 60:02d}"
+
+
+@lru_cache(maxsize=8192)
+def day_text(days):
+    d = date.fromordinal(EPOCH + days)
+    return f"{d.year:04d}-{d.month:02d}-{d.day:02d}"
+
+
+class Ticket:
+    # Memory-lean ticket record. Same fields as the dicts in repair_data.json
+    # but in slots, with repeated strings interned and dates packed into
+    # ints, which takes a ticket from roughly a kilobyte to a few hundred
+    # bytes. It behaves like a read/write mapping (ticket['status'], get,
+    # update, dict(ticket)), so code written for the dicts keeps working;
+    # as_dict() gives back exactly the dict it was built from.
+
+    __slots__ = FIELDS + ("extra",)
+    __hash__ = None
+
+    def __init__(self, data):
+        self.extra = None
+        # __setitem__ inlined, this runs for every ticket on every load
+        for key, value in (data.items() if hasattr(data, "items") else data):
+            convert = STORED_AS.get(key, False)
+            if convert is False:
+                self[key] = value
+            else:
+                object.__setattr__(self, key, value if convert is None else convert(value))
+
+    @classmethod
+    def from_dict(cls, data):
+        return data if type(data) is cls else cls(data)
+
+    def __getitem__(self, key):
+        if key in FIELD_SET:
+            try:
+                value = getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+            return unpack_date(value) if key in DATE_FIELDS else value
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in STORED_AS:
+            convert = STORED_AS[key]
+            object.__setattr__(self, key, value if convert is None else convert(value))
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [field for field in FIELDS if hasattr(self, field)]
+        if self.extra:
+            keys.extend(self.extra)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def update(self, data=(), **fields):
+        items = data.items() if hasattr(data, "items") else data
+        for key, value in items:
+            self[key] = value
+        for key, value in fields.items():
+            self[key] = value
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def copy(self):
+        return self.as_dict()
+
+    def __eq__(self, other):
+        if isinstance(other, Ticket):
+            other = other.as_dict()
+        if not isinstance(other, dict):
+            return NotImplemented
+        return self.as_dict() == other
+
+    def __repr__(self):
+        return f"Ticket({self.as_dict()!r})"
+
+
+def plain(value):
+    # default= hook for json.dump(s) wherever tickets get serialized
+    if isinstance(value, Ticket):
+        return value.as_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")